@@ -0,0 +1,41 @@
+-- Batched capture writes for the MQTT worker
+-- Run this in Supabase SQL Editor
+
+-- The worker marks finalized captures as stored with one bulk_update_captures()
+-- call per main-loop tick instead of one UPDATE per image, and upserts capture
+-- rows from metadata with a single INSERT ... ON CONFLICT instead of
+-- SELECT followed by UPDATE or INSERT.
+
+-- ON CONFLICT (device_id, device_capture_id) requires a unique index.
+-- Remove duplicate rows first if this fails:
+--   SELECT device_id, device_capture_id, count(*) FROM public.captures
+--   GROUP BY 1, 2 HAVING count(*) > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_captures_device_capture_id_unique
+ON public.captures(device_id, device_capture_id);
+
+-- rows: [{"capture_id": uuid, "st": text, "sp": text, "sha": text, "sz": int, "url": text|null}, ...]
+CREATE OR REPLACE FUNCTION public.bulk_update_captures(rows jsonb)
+RETURNS integer
+LANGUAGE sql
+AS $$
+  WITH updated AS (
+    UPDATE public.captures
+    SET ingest_status = v.st,
+        storage_path = v.sp,
+        image_sha256 = v.sha,
+        image_bytes = v.sz,
+        image_url = COALESCE(v.url, public.captures.image_url)
+    FROM jsonb_to_recordset(rows) AS v(capture_id uuid, st text, sp text, sha text, sz int, url text)
+    WHERE public.captures.capture_id = v.capture_id
+    RETURNING 1
+  )
+  SELECT count(*)::integer FROM updated;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.bulk_update_captures(jsonb) TO service_role;
+
+-- Comments
+COMMENT ON FUNCTION public.bulk_update_captures(jsonb) IS 'Mark a batch of captures as stored; returns rows updated. Used by gxp-mqtt-worker flush_capture_updates()';
+
+-- Verify
+-- SELECT public.bulk_update_captures('[]'::jsonb);
@@ -0,0 +1,85 @@
+-- Materialize captures_with_sensors
+-- Run this in Supabase SQL Editor (after migrate_to_jsonb_sensors.sql)
+
+-- The plain view re-extracts and casts every sensor_data field on each read.
+-- As a materialized view the numeric columns are stored and indexed, so
+-- range filters on temperature_c etc. are plain B-tree scans. Rows lag
+-- captures until the next refresh_captures_with_sensors().
+
+-- Replace the plain view from migrate_to_jsonb_sensors.sql (DROP VIEW errors
+-- on a materialized view, so only drop it if it is still a plain view)
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relname = 'captures_with_sensors' AND c.relkind = 'v'
+  ) THEN
+    DROP VIEW public.captures_with_sensors;
+  END IF;
+END;
+$$;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS public.captures_with_sensors AS
+SELECT
+  c.capture_id,
+  c.device_id,
+  c.device_capture_id,
+  c.captured_at,
+  c.image_url,
+  c.storage_path,
+  c.ingest_status,
+  c.image_bytes,
+  c.image_sha256,
+  (c.sensor_data->>'temperature_c')::numeric as temperature_c,
+  (c.sensor_data->>'humidity_pct')::numeric as humidity_pct,
+  (c.sensor_data->>'pressure_hpa')::numeric as pressure_hpa,
+  (c.sensor_data->>'gas_kohm')::numeric as gas_kohm,
+  c.sensor_data,
+  c.created_at
+FROM public.captures c;
+
+-- REFRESH ... CONCURRENTLY requires a unique index
+CREATE UNIQUE INDEX IF NOT EXISTS idx_captures_with_sensors_capture_id
+ON public.captures_with_sensors (capture_id);
+
+CREATE INDEX IF NOT EXISTS idx_captures_with_sensors_temperature
+ON public.captures_with_sensors (temperature_c) WHERE temperature_c IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_captures_with_sensors_humidity
+ON public.captures_with_sensors (humidity_pct) WHERE humidity_pct IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_captures_with_sensors_device_captured_at
+ON public.captures_with_sensors (device_id, captured_at DESC);
+
+-- Materialized views are not covered by captures' RLS policies
+REVOKE ALL ON public.captures_with_sensors FROM anon, authenticated;
+GRANT SELECT ON public.captures_with_sensors TO service_role;
+
+-- REFRESH needs the view owner, hence SECURITY DEFINER. CONCURRENTLY keeps
+-- the view readable while it rebuilds.
+CREATE OR REPLACE FUNCTION public.refresh_captures_with_sensors()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+  REFRESH MATERIALIZED VIEW CONCURRENTLY public.captures_with_sensors;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION public.refresh_captures_with_sensors() FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION public.refresh_captures_with_sensors() TO service_role;
+
+-- Comments
+COMMENT ON MATERIALIZED VIEW public.captures_with_sensors IS 'Captures with sensor data extracted as indexed columns. Refreshed by refresh_captures_with_sensors()';
+COMMENT ON FUNCTION public.refresh_captures_with_sensors() IS 'REFRESH MATERIALIZED VIEW CONCURRENTLY captures_with_sensors. Scheduled with pg_cron; test_jsonb_schema.py Test 6 calls it before reading';
+
+-- Schedule (requires the pg_cron extension: Database > Extensions)
+-- SELECT cron.schedule('refresh-captures-with-sensors', '* * * * *',
+--   'SELECT public.refresh_captures_with_sensors()');
+
+-- Verify
+-- SELECT public.refresh_captures_with_sensors();
+-- EXPLAIN SELECT capture_id FROM public.captures_with_sensors WHERE temperature_c BETWEEN 20 AND 40;
@@ -0,0 +1,46 @@
+-- Command claim RPC for the MQTT worker
+-- Run this in Supabase SQL Editor
+
+-- poll_and_send_commands() claims queued commands with one UPDATE instead of
+-- SELECT followed by one UPDATE per command. FOR UPDATE SKIP LOCKED lets
+-- several workers claim concurrently without sending a command twice.
+-- Claimed rows are marked 'sent' up front; the worker then marks commands it
+-- cannot build 'failed' and puts ones whose publish failed back to 'queued'.
+
+CREATE OR REPLACE FUNCTION public.claim_queued_commands(_limit integer DEFAULT 64)
+RETURNS TABLE (
+  command_id uuid,
+  device_id uuid,
+  command_type text,
+  command_payload jsonb,
+  device_hw_id text
+)
+LANGUAGE sql
+AS $$
+  WITH claimed AS (
+    UPDATE public.device_commands dc
+    SET status = 'sent',
+        sent_at = now()
+    WHERE dc.command_id IN (
+      SELECT q.command_id
+      FROM public.device_commands q
+      WHERE q.status = 'queued'
+      ORDER BY q.requested_at
+      LIMIT _limit
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING dc.command_id, dc.device_id, dc.command_type, dc.command_payload, dc.requested_at
+  )
+  SELECT c.command_id, c.device_id, c.command_type::text, c.command_payload, d.device_hw_id
+  FROM claimed c
+  JOIN public.devices d ON d.device_id = c.device_id
+  ORDER BY c.requested_at;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.claim_queued_commands(integer) TO service_role;
+
+-- Comments
+COMMENT ON FUNCTION public.claim_queued_commands(integer) IS 'Atomically mark up to _limit queued commands sent and return them with the device MAC. Used by gxp-mqtt-worker poll_and_send_commands()';
+
+-- Verify
+-- SELECT * FROM public.claim_queued_commands(0);
@@ -0,0 +1,31 @@
+-- device_commands NOTIFY trigger for the MQTT worker
+-- Run this in Supabase SQL Editor
+
+-- With SUPABASE_DB_URL set, the worker LISTENs on device_command_queued and
+-- sends new commands as soon as they are inserted, polling device_commands
+-- only every COMMAND_POLL_INTERVAL_S as a fallback.
+
+CREATE OR REPLACE FUNCTION public.notify_device_command_queued()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM pg_notify('device_command_queued', NEW.command_id::text);
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS device_commands_notify ON public.device_commands;
+
+CREATE TRIGGER device_commands_notify
+AFTER INSERT ON public.device_commands
+FOR EACH ROW
+WHEN (NEW.status = 'queued')
+EXECUTE FUNCTION public.notify_device_command_queued();
+
+-- Comments
+COMMENT ON FUNCTION public.notify_device_command_queued() IS 'NOTIFY device_command_queued with the new command_id. Used by gxp-mqtt-worker command_listener()';
+
+-- Verify (in a psql session)
+-- LISTEN device_command_queued;
+-- INSERT INTO public.device_commands (device_id, command_type, status) VALUES ('<device_id>', 'capture_image', 'queued');
@@ -0,0 +1,81 @@
+-- sensor_data index tuning for captures
+-- Run this in Supabase SQL Editor (after migrate_to_jsonb_sensors.sql)
+
+-- The index statements use CONCURRENTLY so the running worker's capture
+-- inserts and updates are not blocked while the indexes build. CONCURRENTLY
+-- cannot run inside a transaction block, and the SQL Editor wraps a
+-- multi-statement run in one: run each index statement on its own (select it
+-- and run), or run the file with psql, which sends statements one by one.
+
+-- Sensor lookups are containment queries (sensor_data @> '{"temperature_c": 25.5}').
+-- jsonb_path_ops supports only @>, @? and @@, but its index is roughly half the
+-- size of the default jsonb_ops and faster to probe. Databases migrated before
+-- this change have a jsonb_ops index under the same name, so rebuild it.
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_captures_sensor_data_gin;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_captures_sensor_data_gin
+ON public.captures USING GIN (sensor_data jsonb_path_ops);
+
+-- GIN cannot serve ->> range predicates; those need expression B-trees.
+-- migrate_to_jsonb_sensors.sql covers temperature and humidity.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_captures_pressure
+ON public.captures (((sensor_data->>'pressure_hpa')::numeric))
+WHERE sensor_data->>'pressure_hpa' IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_captures_gas
+ON public.captures (((sensor_data->>'gas_kohm')::numeric))
+WHERE sensor_data->>'gas_kohm' IS NOT NULL;
+
+-- Temperature range query. The IS NOT NULL clause repeats the partial-index
+-- predicate so the planner can use idx_captures_temperature.
+CREATE OR REPLACE FUNCTION public.captures_in_temp_range(lo numeric, hi numeric)
+RETURNS SETOF public.captures
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT c.*
+  FROM public.captures c
+  WHERE c.sensor_data->>'temperature_c' IS NOT NULL
+    AND (c.sensor_data->>'temperature_c')::numeric BETWEEN lo AND hi;
+$$;
+
+-- EXPLAIN (ANALYZE, BUFFERS) of the same predicate, for checking index use
+CREATE OR REPLACE FUNCTION public.explain_captures_in_temp_range(lo numeric, hi numeric)
+RETURNS SETOF text
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN QUERY EXECUTE format(
+    'EXPLAIN (ANALYZE, BUFFERS) SELECT c.capture_id FROM public.captures c '
+    'WHERE c.sensor_data->>''temperature_c'' IS NOT NULL '
+    'AND (c.sensor_data->>''temperature_c'')::numeric BETWEEN %L AND %L',
+    lo, hi);
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.captures_in_temp_range(numeric, numeric) TO service_role;
+GRANT EXECUTE ON FUNCTION public.explain_captures_in_temp_range(numeric, numeric) TO service_role;
+
+-- Index definitions on captures, so test_jsonb_schema.py can check them
+-- without direct database access
+CREATE OR REPLACE FUNCTION public.captures_index_defs()
+RETURNS TABLE (indexname text, indexdef text)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT i.indexname::text, i.indexdef
+  FROM pg_indexes i
+  WHERE i.schemaname = 'public' AND i.tablename = 'captures'
+  ORDER BY i.indexname;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.captures_index_defs() TO service_role;
+
+-- Comments
+COMMENT ON FUNCTION public.captures_in_temp_range(numeric, numeric) IS 'Captures whose sensor_data temperature_c is between lo and hi (served by idx_captures_temperature)';
+COMMENT ON FUNCTION public.explain_captures_in_temp_range(numeric, numeric) IS 'Query plan for captures_in_temp_range. Used by test_jsonb_schema.py Test 4';
+COMMENT ON FUNCTION public.captures_index_defs() IS 'List index definitions on public.captures. Used by test_jsonb_schema.py Test 7';
+
+-- Verify
+-- SELECT * FROM public.captures_index_defs();
+-- SELECT * FROM public.explain_captures_in_temp_range(20, 40);
@@ -0,0 +1,52 @@
+-- Device upsert RPC for the MQTT worker
+-- Run this in Supabase SQL Editor
+
+-- ensure_device() resolves a device_hw_id to its device_id in one round-trip
+-- instead of SELECT followed by UPDATE or INSERT. The upsert also closes the
+-- race where two worker threads insert the same new device concurrently.
+
+-- ON CONFLICT (device_hw_id) requires a unique index on the MAC
+CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_device_hw_id_unique
+ON public.devices(device_hw_id);
+
+CREATE OR REPLACE FUNCTION public.upsert_device(_hw_id text, _ip text DEFAULT NULL)
+RETURNS uuid
+LANGUAGE sql
+AS $$
+  INSERT INTO public.devices (device_hw_id, model, last_seen_at, last_ip)
+  VALUES (_hw_id, 'ESP32S3-CAM', now(), _ip)
+  ON CONFLICT (device_hw_id) DO UPDATE
+    SET last_seen_at = now(),
+        last_ip = COALESCE(EXCLUDED.last_ip, public.devices.last_ip)
+  RETURNING device_id;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.upsert_device(text, text) TO service_role;
+
+-- Cached devices are touched in batches. UPDATE only: an INSERT ... ON
+-- CONFLICT would check NOT NULL columns (model, ...) on rows that only carry
+-- last_seen_at, and would re-create a device deleted behind the cache.
+-- rows: [{"device_id": uuid, "last_seen_at": timestamptz, "last_ip": text|null}, ...]
+CREATE OR REPLACE FUNCTION public.bulk_touch_devices(rows jsonb)
+RETURNS integer
+LANGUAGE sql
+AS $$
+  WITH updated AS (
+    UPDATE public.devices
+    SET last_seen_at = v.last_seen_at,
+        last_ip = COALESCE(v.last_ip, public.devices.last_ip)
+    FROM jsonb_to_recordset(rows) AS v(device_id uuid, last_seen_at timestamptz, last_ip text)
+    WHERE public.devices.device_id = v.device_id
+    RETURNING 1
+  )
+  SELECT count(*)::integer FROM updated;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.bulk_touch_devices(jsonb) TO service_role;
+
+-- Comments
+COMMENT ON FUNCTION public.upsert_device(text, text) IS 'Insert or touch a device by MAC; returns device_id. Used by gxp-mqtt-worker ensure_device()';
+COMMENT ON FUNCTION public.bulk_touch_devices(jsonb) IS 'Update last_seen_at/last_ip for a batch of existing devices; returns rows updated. Used by gxp-mqtt-worker flush_device_touches()';
+
+-- Verify
+-- SELECT public.upsert_device('AABBCCDDEEFF');
@@ -7,19 +7,37 @@ stores to Supabase Storage, and persists metadata + sensor data to database.
 
 import os
 import ssl
-import json
 import time
-import base64
 import hashlib
 import logging
+import queue
 import signal
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, List, Tuple
+from urllib.parse import urlparse
 
+import httpx
+import orjson
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import pybase64
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+from http_session import use_keepalive_session
+from tls_session import ResumingSSLContext
+
+try:
+    import psycopg  # optional: LISTEN/NOTIFY command wakeups
+except ImportError:
+    psycopg = None
+
 # Load environment variables from .env file (for local development)
 load_dotenv()
 
@@ -29,6 +47,13 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_TLS = os.getenv("MQTT_TLS", "true").lower() == "true"
 MQTT_USERNAME = os.getenv("MQTT_USERNAME", "BrainlyTesting")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+# A stable client ID + session expiry lets the broker keep our subscriptions
+# and queue QoS-1 chunks while the worker restarts. The ID must differ per
+# replica (the broker disconnects the older of two clients sharing one), so
+# the default is derived from the hostname, which survives process restarts.
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID") or f"gxp-worker-{socket.gethostname()}"
+MQTT_SESSION_EXPIRY_S = int(os.getenv("MQTT_SESSION_EXPIRY_S", "3600"))
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", "1000"))
 
 # ESP32 firmware uses these topic patterns:
 # ESP32CAM/{MAC}/data   - image chunks + metadata + sensor data
@@ -38,16 +63,39 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 TOPIC_PATTERN_DATA = os.getenv("TOPIC_PATTERN_DATA", "ESP32CAM/+/data")
 TOPIC_PATTERN_STATUS = os.getenv("TOPIC_PATTERN_STATUS", "ESP32CAM/+/status")
 TOPIC_PATTERN_ACK = os.getenv("TOPIC_PATTERN_ACK", "ESP32CAM/+/ack")
+# ESP32CAM/{MAC}/chunk/{chunk_id} - raw binary image chunk (MQTT v5)
+TOPIC_PATTERN_CHUNK = os.getenv("TOPIC_PATTERN_CHUNK", "ESP32CAM/+/chunk/+")
 
 # Assembly & retry configuration
 CAPTURE_TIMEOUT_MS = int(os.getenv("CAPTURE_TIMEOUT_MS", "60000"))
 RETRANSMIT_DELAY_MS = int(os.getenv("RETRANSMIT_DELAY_MS", "3000"))
 RETRANSMIT_MAX = int(os.getenv("RETRANSMIT_MAX", "3"))
+# Chunks for an image finalized less than this long ago are duplicates
+FINALIZED_TTL_S = float(os.getenv("FINALIZED_TTL_S", "120"))
+
+# Database write batching
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "1000"))
+INSERT_FLUSH_THRESHOLD = int(os.getenv("INSERT_FLUSH_THRESHOLD", "500"))
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", "4096"))
+# Attempts at a finalized capture's row update before it is given up
+CAPTURE_UPDATE_ATTEMPTS = int(os.getenv("CAPTURE_UPDATE_ATTEMPTS", "5"))
+
+# Completed images are uploaded/finalized off the main loop
+FINALIZE_WORKERS = int(os.getenv("FINALIZE_WORKERS", "8"))
+
+# Inbound messages are handled off the Paho network thread
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "4"))
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "10000"))
 
 # Supabase configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE")
 STORAGE_BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET", "gxp-captures")
+# Direct Postgres URL (Supavisor session mode, port 5432) for LISTEN on
+# device_commands inserts. Unset: device_commands is polled every tick.
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+COMMAND_POLL_INTERVAL_S = float(os.getenv("COMMAND_POLL_INTERVAL_S", "30"))
+COMMAND_CLAIM_LIMIT = int(os.getenv("COMMAND_CLAIM_LIMIT", "64"))
 
 # Logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -62,9 +110,143 @@ if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE:
     log.error("SUPABASE_URL and SUPABASE_SERVICE_ROLE must be set!")
     exit(1)
 
-sb: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE)
+def make_supabase_client() -> Client:
+    """
+    Create the Supabase client with a PostgREST session that keeps idle
+    connections for a minute (httpx default: 5s), so writes after a quiet
+    spell reuse a warm HTTP/2 connection instead of a new TCP+TLS handshake.
+    """
+    return use_keepalive_session(
+        create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE),
+        httpx.Limits(max_connections=64, max_keepalive_connections=32,
+                     keepalive_expiry=60),
+        httpx.Timeout(30.0, connect=5.0)
+    )
+
+
+sb: Client = make_supabase_client()
 log.info("Supabase client initialized: %s", SUPABASE_URL)
 
+# Storage uploads go straight to the Storage REST API over a keep-alive
+# connection pool shared by the finalize threads
+_storage_http = httpx.Client(
+    base_url=f"{SUPABASE_URL.rstrip('/')}/storage/v1",
+    headers={
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE}",
+        "apikey": SUPABASE_SERVICE_ROLE
+    },
+    limits=httpx.Limits(max_connections=FINALIZE_WORKERS,
+                        max_keepalive_connections=FINALIZE_WORKERS),
+    transport=httpx.HTTPTransport(retries=2),  # connect failures only
+    timeout=30.0
+)
+
+
+# ------------ Batched Inserts ------------
+# Append-only log tables are queued here and written with one PostgREST
+# array insert per table per main-loop tick, instead of one HTTP round-trip
+# per MQTT message.
+_pending_inserts: Dict[str, deque] = {
+    "device_publish_log": deque(),
+    "device_status": deque(),
+    "device_errors": deque(),
+    "device_command_logs": deque(),
+}
+
+
+def queue_insert(table: str, row: dict):
+    """Queue a row for the next batched insert into `table`."""
+    pending = _pending_inserts[table]
+    pending.append(row)
+    if len(pending) >= INSERT_FLUSH_THRESHOLD:
+        flush_table(table)
+
+
+def flush_table(table: str):
+    """Drain the queue for `table` and insert the rows in batches."""
+    pending = _pending_inserts[table]
+    rows = []
+    while True:
+        try:
+            rows.append(pending.popleft())
+        except IndexError:
+            break
+
+    # PostgREST rejects array inserts whose objects have different keys,
+    # so rows with different optional fields go out as separate batches.
+    groups: Dict[Tuple[str, ...], list] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    for group in groups.values():
+        for i in range(0, len(group), INSERT_BATCH_SIZE):
+            batch = group[i:i + INSERT_BATCH_SIZE]
+            try:
+                sb.table(table).insert(batch, returning="minimal").execute()
+            except Exception as e:
+                log.warning("%s batch insert failed (%d rows): %s", table, len(batch), e)
+
+
+# ------------ Batched Capture Updates ------------
+# Finalize tasks queue their "stored" update here; the main loop writes them
+# with one bulk_update_captures RPC and only then ACKs each image, so a device
+# never deletes an image whose capture row was not updated.
+# Entries: (device_id, device_hw_id, image_name, row, attempts)
+_pending_capture_updates: deque = deque()
+# (monotonic due time, entry) for failed updates; main loop only
+_capture_update_retries: List[Tuple[float, tuple]] = []
+
+
+def queue_capture_update(device_id: str, device_hw_id: str, image_name: str, row: dict):
+    """Queue a finalized capture's update and the ACK_OK that depends on it."""
+    _pending_capture_updates.append((device_id, device_hw_id, image_name, row, 0))
+    loop_wakeup.set()  # write and ACK now rather than on the next tick
+
+
+def flush_capture_updates(client: mqtt.Client):
+    """Write queued capture updates in batches, then ACK the devices."""
+    now = time.monotonic()
+    pending = [entry for due, entry in _capture_update_retries if due <= now]
+    _capture_update_retries[:] = [r for r in _capture_update_retries if r[0] > now]
+    while True:
+        try:
+            pending.append(_pending_capture_updates.popleft())
+        except IndexError:
+            break
+
+    for i in range(0, len(pending), INSERT_BATCH_SIZE):
+        batch = pending[i:i + INSERT_BATCH_SIZE]
+        try:
+            sb.rpc("bulk_update_captures", {"rows": [p[3] for p in batch]}).execute()
+        except Exception as e:
+            # The image is already in storage; retry just the row update with
+            # backoff. No ACK until it lands, and after the last attempt the
+            # row stays 'assembling' with a 2205 error logged.
+            log.warning("bulk_update_captures failed (%d rows): %s", len(batch), e)
+            for device_id, device_hw_id, image_name, row, attempts in batch:
+                attempts += 1
+                if attempts < CAPTURE_UPDATE_ATTEMPTS:
+                    _capture_update_retries.append(
+                        (now + min(2 ** attempts, 30),
+                         (device_id, device_hw_id, image_name, row, attempts)))
+                else:
+                    insert_error(device_id, row["capture_id"], 2205, "error",
+                                 "capture_update_failed",
+                                 {"error": str(e), "attempts": attempts})
+            continue
+
+        for _, device_hw_id, image_name, row, _ in batch:
+            log.info("[%s] Capture finalized: %s (status=success, %d bytes, sha256=%s)",
+                     device_hw_id, row["capture_id"], row["sz"], row["sha"][:16])
+            publish_ack_ok(client, device_hw_id, image_name)
+
+
+def flush_pending_inserts():
+    """Flush all queued log rows and device touches to the database."""
+    for table in _pending_inserts:
+        flush_table(table)
+    flush_device_touches()
+
 
 # ------------ Helper Functions ------------
 def now_iso() -> str:
@@ -72,62 +254,108 @@ def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def sha256_hex(b: bytes) -> str:
-    """Calculate SHA256 hash of bytes."""
+def sha256_hex(b) -> str:
+    """Calculate SHA256 hash of a bytes-like object."""
     return hashlib.sha256(b).hexdigest()
 
 
+def upload_image(storage_path: str, img_bytes: bytes):
+    """Upload (upsert) a JPEG to the storage bucket. Raises on HTTP errors."""
+    res = _storage_http.post(
+        f"/object/{STORAGE_BUCKET}/{storage_path}",
+        content=img_bytes,
+        headers={"Content-Type": "image/jpeg", "x-upsert": "true"}
+    )
+    res.raise_for_status()
+
+
 def extract_mac_from_topic(topic: str) -> str:
     """
     Extract device MAC address from topic.
     Topic format: ESP32CAM/{MAC}/data
-    Returns MAC without colons (e.g., 'AABBCCDDEEFF')
+    Returns MAC without colons (e.g., 'AABBCCDDEEFF'), interned since the
+    same MACs recur as assembly/cache keys on every message.
+    """
+    return split_topic(topic)[0]
+
+
+def split_topic(topic: str) -> Tuple[str, str]:
+    """
+    Split a device topic into (MAC, kind) without allocating a list.
+    ESP32CAM/{MAC}/data -> ('AABBCCDDEEFF', 'data')
+    ESP32CAM/{MAC}/chunk/{chunk_id} -> ('AABBCCDDEEFF', 'chunk')
     """
-    parts = topic.split("/")
-    if len(parts) >= 2:
-        return parts[1]
-    return "unknown"
+    _, sep, rest = topic.partition("/")
+    if not sep:
+        return "unknown", ""
+    mac, _, rest = rest.partition("/")
+    kind, _, _ = rest.partition("/")
+    return sys.intern(mac), kind
+
+
+# device_hw_id -> device_id for devices already looked up or registered
+_device_id_cache: Dict[str, str] = {}
+_device_cache_lock = threading.Lock()
+
+# device_id -> pending last_seen_at/last_ip touch, collapsed per device
+_pending_touches: Dict[str, dict] = {}
+
+
+def touch_device(device_id: str, last_ip: Optional[str] = None):
+    """Queue a last_seen_at update; only the latest touch per device is kept."""
+    row = {"device_id": device_id, "last_seen_at": now_iso(), "last_ip": last_ip}
+    with _device_cache_lock:
+        _pending_touches[device_id] = row
+
+
+def flush_device_touches():
+    """Write queued last_seen_at updates with one bulk_touch_devices call."""
+    global _pending_touches
+    with _device_cache_lock:
+        rows = list(_pending_touches.values())
+        _pending_touches = {}
+    if not rows:
+        return
+
+    # UPDATE only (add_upsert_device_rpc.sql): a touch never inserts, so a
+    # device deleted behind the cache is not re-created without its columns
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[i:i + INSERT_BATCH_SIZE]
+        try:
+            sb.rpc("bulk_touch_devices", {"rows": batch}).execute()
+        except Exception as e:
+            log.warning("devices last_seen_at update failed (%d rows): %s", len(batch), e)
 
 
 def ensure_device(device_hw_id: str, last_ip: Optional[str] = None) -> str:
     """
     Upsert device by device_hw_id (MAC address without colons).
-    Updates last_seen_at timestamp.
+    The first call per device goes through the upsert_device RPC; later
+    calls are served from an in-process cache and queue a last_seen_at
+    touch (see flush_device_touches).
     Returns device_id (UUID).
     """
-    try:
-        # Check if device exists
-        res = sb.table("devices")\
-            .select("device_id")\
-            .eq("device_hw_id", device_hw_id)\
-            .limit(1)\
-            .execute()
+    with _device_cache_lock:
+        device_id = _device_id_cache.get(device_hw_id)
+    if device_id:
+        touch_device(device_id, last_ip)
+        return device_id
 
-        if res.data:
-            device_id = res.data[0]["device_id"]
-            # Update last_seen_at
-            update_data = {"last_seen_at": now_iso()}
-            if last_ip:
-                update_data["last_ip"] = last_ip
-            sb.table("devices")\
-                .update(update_data)\
-                .eq("device_id", device_id)\
-                .execute()
-            log.debug("Device %s updated (device_id=%s)", device_hw_id, device_id)
-            return device_id
-        else:
-            # Insert new device
-            ins_data = {
-                "device_hw_id": device_hw_id,
-                "model": "ESP32S3-CAM",
-                "last_seen_at": now_iso()
-            }
-            if last_ip:
-                ins_data["last_ip"] = last_ip
-            ins = sb.table("devices").insert(ins_data).execute()
-            device_id = ins.data[0]["device_id"]
-            log.info("New device registered: %s (device_id=%s)", device_hw_id, device_id)
-            return device_id
+    try:
+        # Single round-trip INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+        # (see add_upsert_device_rpc.sql); also refreshes last_seen_at
+        res = sb.rpc("upsert_device", {"_hw_id": device_hw_id, "_ip": last_ip}).execute()
+        device_id = res.data
+        if not device_id:
+            raise RuntimeError("upsert_device returned no device_id")
+        log.info("Device resolved: %s (device_id=%s)", device_hw_id, device_id)
+
+        with _device_cache_lock:
+            if len(_device_id_cache) >= DEVICE_CACHE_SIZE:
+                # Evict the oldest entry (dicts keep insertion order)
+                _device_id_cache.pop(next(iter(_device_id_cache)))
+            _device_id_cache[device_hw_id] = device_id
+        return device_id
     except Exception as e:
         log.error("ensure_device failed for %s: %s", device_hw_id, e)
         raise
@@ -154,8 +382,8 @@ def insert_device_status(device_id: str, status: str, raw: dict, pending: Option
         if boot_count is not None:
             row["boot_count"] = boot_count
 
-        sb.table("device_status").insert(row).execute()
-        log.debug("Device status inserted for %s: %s", device_id, status)
+        queue_insert("device_status", row)
+        log.debug("Device status queued for %s: %s", device_id, status)
     except Exception as e:
         log.warning("device_status insert failed: %s", e)
 
@@ -163,12 +391,12 @@ def insert_device_status(device_id: str, status: str, raw: dict, pending: Option
 def log_publish(device_id: Optional[str], topic: str, direction: str, payload_json: dict):
     """Log MQTT publish/subscribe to device_publish_log table."""
     try:
-        sb.table("device_publish_log").insert({
+        queue_insert("device_publish_log", {
             "device_id": device_id,
             "topic": topic,
             "direction": direction,
             "payload": payload_json
-        }).execute()
+        })
     except Exception as e:
         log.warning("device_publish_log insert failed: %s", e)
 
@@ -177,14 +405,14 @@ def insert_error(device_id: str, capture_id: Optional[str], code: int, severity:
                 message: str, details: dict):
     """Insert device error record."""
     try:
-        sb.table("device_errors").insert({
+        queue_insert("device_errors", {
             "device_id": device_id,
             "capture_id": capture_id,
             "error_code": code,
             "severity": severity,
             "message": message,
             "details": details
-        }).execute()
+        })
         log.warning("Error %d logged for device %s: %s", code, device_id, message)
     except Exception as e:
         log.error("device_errors insert failed: %s", e)
@@ -249,24 +477,14 @@ def upsert_capture_from_metadata(device_id: str, meta: dict) -> Tuple[str, dict]
     }
 
     try:
-        # Check if capture already exists (upsert by device_id + device_capture_id)
-        existing = sb.table("captures")\
-            .select("capture_id")\
-            .eq("device_id", device_id)\
-            .eq("device_capture_id", image_name)\
-            .limit(1)\
+        # Single-statement upsert on (device_id, device_capture_id); a re-sent
+        # metadata message resets the existing row instead of duplicating it
+        res = sb.table("captures")\
+            .upsert(cap_row, on_conflict="device_id,device_capture_id")\
             .execute()
-
-        if existing.data:
-            capture_id = existing.data[0]["capture_id"]
-            sb.table("captures").update(cap_row).eq("capture_id", capture_id).execute()
-            log.debug("Capture updated: %s (capture_id=%s)", image_name, capture_id)
-            return capture_id, cap_row
-        else:
-            ins = sb.table("captures").insert(cap_row).execute()
-            capture_id = ins.data[0]["capture_id"]
-            log.info("Capture created: %s (capture_id=%s)", image_name, capture_id)
-            return capture_id, cap_row
+        capture_id = res.data[0]["capture_id"]
+        log.info("Capture upserted: %s (capture_id=%s)", image_name, capture_id)
+        return capture_id, cap_row
     except Exception as e:
         log.error("upsert_capture_from_metadata failed: %s", e)
         raise
@@ -303,53 +521,170 @@ def build_sensor_data_jsonb(meta: dict) -> dict:
 
 
 # ------------ Image Assembly State ------------
+# JPEG start/end-of-image markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+# Assembly buffers are recycled across captures instead of being allocated
+# per image. Images larger than _BUF_SIZE get a dedicated, unpooled buffer.
+# Only finalized assemblies return their buffer; a timed-out one may still be
+# written to by a late chunk, so its buffer is left to the garbage collector.
+_BUF_SIZE = 2 * 1024 * 1024
+_POOL_MAX = 64
+_assembly_pool: List[bytearray] = []
+
+
+def _acquire_buffer(size: int) -> bytearray:
+    """Take a pooled buffer that can hold `size` bytes, or allocate one."""
+    if size > _BUF_SIZE:
+        return bytearray(size)
+    try:
+        return _assembly_pool.pop()
+    except IndexError:
+        return bytearray(_BUF_SIZE)
+
+
+def _release_buffer(buf: bytearray):
+    """Return a buffer to the pool (contents are not cleared)."""
+    if len(buf) == _BUF_SIZE and len(_assembly_pool) < _POOL_MAX:
+        _assembly_pool.append(buf)
+
+
 class ImageAssembly:
     """Manages state for assembling a chunked image from ESP32 device."""
 
+    __slots__ = ("device_hw_id", "image_name", "total_chunks", "chunk_size",
+                 "declared_size", "t0", "buf", "received", "chunks_received",
+                 "bytes_received", "retries", "last_nack_ts", "capture_id",
+                 "nack_rle", "early")
+
     def __init__(self, device_hw_id: str, image_name: str, total_chunks: int,
                 chunk_size: int, declared_size: int):
         self.device_hw_id = device_hw_id
         self.image_name = image_name
         self.total_chunks = int(total_chunks) if total_chunks else 0
-        self.chunk_size = int(chunk_size) if chunk_size else 1024
+        self.chunk_size = int(chunk_size) if chunk_size else 0
         self.declared_size = int(declared_size) if declared_size else 0
         self.t0 = time.time()
-        self.bitset = [False] * max(self.total_chunks, 1)
-        self.chunks: Dict[int, bytes] = {}
+        # Chunks are copied straight to their offset in one contiguous buffer;
+        # `received` is a one-byte-per-chunk bitmap. Pooled buffers are not
+        # cleared, so every chunk but the last must fill its slot exactly:
+        # a complete assembly then has no gaps before bytes_received.
+        if self.total_chunks and self.chunk_size:
+            self.buf = _acquire_buffer(self.total_chunks * self.chunk_size)
+            self.early: Optional[Dict[int, bytes]] = None
+        else:
+            # Opened by a chunk without size hints: the layout is unknown
+            # until metadata arrives, so hold chunks by ID (see relayout)
+            self.buf = bytearray()
+            self.early = {}
+        self.received = bytearray(self.total_chunks)
+        self.chunks_received = 0
+        self.bytes_received = 0
         self.retries = 0
         self.last_nack_ts = 0.0
         self.capture_id: Optional[str] = None
+        self.nack_rle = False  # firmware accepts coalesced RLE NACKs
 
     def add_chunk(self, chunk_id: int, chunk_bytes: bytes):
         """Add a chunk to the assembly (chunk_id is 0-indexed in firmware)."""
+        if self.early is not None:
+            if chunk_id >= 0:
+                self.early.setdefault(chunk_id, chunk_bytes)
+            return
         if 0 <= chunk_id < self.total_chunks:
-            if not self.bitset[chunk_id]:
-                self.bitset[chunk_id] = True
-                self.chunks[chunk_id] = chunk_bytes
-                log.debug("[%s] Chunk %d/%d received (%d bytes)",
-                         self.device_hw_id, chunk_id + 1, self.total_chunks, len(chunk_bytes))
+            if not self.received[chunk_id]:
+                if len(chunk_bytes) > self.chunk_size:
+                    log.warning("[%s] Chunk %d exceeds chunk size (%d > %d) - dropped",
+                               self.device_hw_id, chunk_id, len(chunk_bytes), self.chunk_size)
+                    return
+                if chunk_id < self.total_chunks - 1 and len(chunk_bytes) != self.chunk_size:
+                    log.warning("[%s] Short non-final chunk %d (%d < %d) - dropped",
+                               self.device_hw_id, chunk_id, len(chunk_bytes), self.chunk_size)
+                    return
+                buf = self.buf
+                if not buf:
+                    return  # assembly already discarded by the timeout sweep
+                off = chunk_id * self.chunk_size
+                memoryview(buf)[off:off + len(chunk_bytes)] = chunk_bytes
+                self.received[chunk_id] = 1
+                self.chunks_received += 1
+                self.bytes_received += len(chunk_bytes)
+                if log.isEnabledFor(logging.DEBUG):  # per-chunk: skip arg building
+                    log.debug("[%s] Chunk %d/%d received (%d bytes)",
+                             self.device_hw_id, chunk_id + 1, self.total_chunks, len(chunk_bytes))
 
     def is_complete(self) -> bool:
         """Check if all chunks have been received."""
-        return all(self.bitset)
+        return self.total_chunks > 0 and self.chunks_received == self.total_chunks
 
     def get_missing_chunks(self) -> list:
         """Return list of missing chunk IDs (0-indexed)."""
-        return [i for i, received in enumerate(self.bitset) if not received]
+        # bytearray.find skips runs of received chunks in C
+        missing = []
+        i = self.received.find(0)
+        while i != -1:
+            missing.append(i)
+            i = self.received.find(0, i + 1)
+        return missing
 
     def is_expired(self) -> bool:
         """Check if assembly has timed out."""
         return (time.time() - self.t0) * 1000 > CAPTURE_TIMEOUT_MS
 
-    def assemble_image(self) -> bytes:
-        """Concatenate all chunks in order to produce final image."""
+    def image_view(self) -> memoryview:
+        """Return a zero-copy view of the assembled image in the buffer."""
         if not self.is_complete():
             raise ValueError("Cannot assemble incomplete image")
-        return b"".join(self.chunks[i] for i in range(self.total_chunks))
+        return memoryview(self.buf)[:self.bytes_received]
+
+    def assemble_image(self) -> bytes:
+        """Return the received bytes in chunk order as the final image."""
+        return self.image_view().tobytes()
+
+    def release(self):
+        """Hand the assembly buffer back to the pool once the image is done."""
+        _release_buffer(self.buf)
+        self.buf = bytearray()
+
+    def discard(self):
+        """Drop the buffer without pooling it (another thread may still write to it)."""
+        self.buf = bytearray()
+        self.early = None
+
+    def relayout(self, total_chunks: int, chunk_size: int) -> "ImageAssembly":
+        """
+        Return a copy of this assembly laid out as the metadata declares.
+        Chunks held before the layout was known are replayed into it; chunks
+        placed under a different layout are dropped and NACKed again.
+        """
+        asm = ImageAssembly(self.device_hw_id, self.image_name, total_chunks,
+                            chunk_size, self.declared_size)
+        asm.t0 = self.t0
+        asm.capture_id = self.capture_id
+        asm.nack_rle = self.nack_rle
+        if self.early:
+            for chunk_id, chunk_bytes in self.early.items():
+                asm.add_chunk(chunk_id, chunk_bytes)
+        self.discard()
+        return asm
 
 
 # Global assembly state: key = (device_hw_id, image_name)
+# Guarded by _assemblies_lock: MQTT callbacks add entries, the main loop
+# removes them.
 assemblies: Dict[Tuple[str, str], ImageAssembly] = {}
+_assemblies_lock = threading.Lock()
+
+# Keys handed to the finalize pool -> time.time() they stop being remembered.
+# A duplicate or retransmitted chunk for one of these is dropped instead of
+# opening a fresh assembly that would reset the finished capture row.
+# Guarded by _assemblies_lock.
+_recently_finalized: Dict[Tuple[str, str], float] = {}
+
+# Storage upload + capture update for completed images
+_finalize_executor = ThreadPoolExecutor(max_workers=FINALIZE_WORKERS,
+                                        thread_name_prefix="finalize")
 
 
 # ------------ MQTT Topic Helpers ------------
@@ -379,12 +714,46 @@ def publish_missing_chunks_nack(client: mqtt.Client, device_hw_id: str,
         "image_name": image_name,
         "missing_chunks": missing_chunks
     }
-    client.publish(topic, json.dumps(payload), qos=1, retain=False)
+    client.publish(topic, orjson.dumps(payload), qos=1, retain=False)
     log_publish(None, topic, "out", payload)
     log.warning("[%s] NACK sent - missing chunks: %s (showing first 10)",
                device_hw_id, missing_chunks[:10])
 
 
+def rle_chunk_ids(chunk_ids: list) -> list:
+    """Run-length encode sorted chunk IDs as [[start, count], ...]."""
+    runs = []
+    for i in chunk_ids:
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return runs
+
+
+def publish_coalesced_nack(client: mqtt.Client, device_hw_id: str, missing_by_image: dict):
+    """
+    Publish one NACK covering every incomplete image of a device, with
+    missing chunk IDs run-length encoded. Only sent to firmware that set
+    "nack_rle": true in its metadata.
+
+    Format:
+    {
+      "missing": {
+        "image_123.jpg": [[5, 1], [12, 40]],
+        "image_124.jpg": [[0, 3]]
+      }
+    }
+    """
+    topic = build_ack_topic(device_hw_id)
+    payload = {
+        "missing": {name: rle_chunk_ids(ids) for name, ids in missing_by_image.items()}
+    }
+    client.publish(topic, orjson.dumps(payload), qos=1, retain=False)
+    log_publish(None, topic, "out", payload)
+    log.warning("[%s] Coalesced NACK sent for %d image(s)", device_hw_id, len(missing_by_image))
+
+
 def publish_ack_ok(client: mqtt.Client, device_hw_id: str, image_name: str,
                   next_wake_time: Optional[str] = None):
     """
@@ -406,7 +775,7 @@ def publish_ack_ok(client: mqtt.Client, device_hw_id: str, image_name: str,
     if next_wake_time:
         ack["ACK_OK"]["next_wake_time"] = next_wake_time
 
-    client.publish(topic, json.dumps(ack), qos=1, retain=False)
+    client.publish(topic, orjson.dumps(ack), qos=1, retain=False)
     log_publish(None, topic, "out", ack)
     log.info("[%s] ACK_OK sent for image: %s", device_hw_id, image_name)
 
@@ -504,14 +873,14 @@ def send_device_config(client: mqtt.Client, device_id: str, device_hw_id: str, p
             log.info("[%s] Device config sent: next_wake (%s)", device_hw_id, next_wake_at)
 
         # Publish command
-        client.publish(cmd_topic, json.dumps(config_msg), qos=1)
+        client.publish(cmd_topic, orjson.dumps(config_msg), qos=1)
         log_publish(device_id, cmd_topic, "out", config_msg)
 
     except Exception as e:
         log.error("[%s] Failed to send device config: %s", device_hw_id, e)
         # Fallback: send capture command to prevent device hang
         fallback_msg = {"device_id": device_hw_id, "capture_image": True}
-        client.publish(cmd_topic, json.dumps(fallback_msg), qos=1)
+        client.publish(cmd_topic, orjson.dumps(fallback_msg), qos=1)
 
 
 # ------------ MQTT Message Handlers ------------
@@ -533,7 +902,7 @@ def handle_status_message(client: mqtt.Client, topic: str, payload: bytes):
     device_hw_id = extract_mac_from_topic(topic)
 
     try:
-        msg = json.loads(payload.decode("utf-8"))
+        msg = orjson.loads(payload)
     except Exception as e:
         log.error("[%s] Failed to parse status JSON: %s", device_hw_id, e)
         return
@@ -586,7 +955,7 @@ def handle_data_message(client: mqtt.Client, topic: str, payload: bytes):
     device_hw_id = extract_mac_from_topic(topic)
 
     try:
-        msg = json.loads(payload.decode("utf-8"))
+        msg = orjson.loads(payload)
     except Exception as e:
         log.error("[%s] Failed to parse data JSON: %s", device_hw_id, e)
         device_id = ensure_device(device_hw_id)
@@ -651,23 +1020,41 @@ def handle_metadata(client: mqtt.Client, device_id: str, device_hw_id: str,
 
         # Initialize assembly state
         key = (device_hw_id, image_name)
-        if key not in assemblies:
-            assemblies[key] = ImageAssembly(
-                device_hw_id=device_hw_id,
-                image_name=image_name,
-                total_chunks=msg.get("total_chunk_count", 0),
-                chunk_size=msg.get("max_chunks_size", 1024),
-                declared_size=msg.get("image_size", 0)
-            )
-            assemblies[key].capture_id = capture_id
-            log.info("[%s] Assembly started for %s (%d chunks, %d bytes)",
-                    device_hw_id, image_name,
-                    assemblies[key].total_chunks, assemblies[key].declared_size)
-        else:
-            # Metadata re-sent; update assembly parameters
-            asm = assemblies[key]
-            asm.declared_size = msg.get("image_size", asm.declared_size)
-            asm.capture_id = capture_id
+        total_chunks = int(msg.get("total_chunk_count") or 0)
+        chunk_size = int(msg.get("max_chunks_size") or 1024)
+        with _assemblies_lock:
+            # A new transmission of a finalized image: accept its chunks again
+            _recently_finalized.pop(key, None)
+            asm = assemblies.get(key)
+            if asm is None:
+                asm = ImageAssembly(
+                    device_hw_id=device_hw_id,
+                    image_name=image_name,
+                    total_chunks=total_chunks,
+                    chunk_size=chunk_size,
+                    declared_size=msg.get("image_size", 0)
+                )
+                asm.capture_id = capture_id
+                asm.nack_rle = bool(msg.get("nack_rle", False))
+                assemblies[key] = asm
+                log.info("[%s] Assembly started for %s (%d chunks, %d bytes)",
+                        device_hw_id, image_name, asm.total_chunks, asm.declared_size)
+            else:
+                # Metadata re-sent, or chunks beat it here; update assembly
+                # parameters
+                asm.declared_size = msg.get("image_size", asm.declared_size)
+                asm.capture_id = capture_id
+                asm.nack_rle = bool(msg.get("nack_rle", asm.nack_rle))
+                if (asm.early is not None or asm.total_chunks != total_chunks
+                        or asm.chunk_size != chunk_size):
+                    asm = asm.relayout(total_chunks, chunk_size)
+                    assemblies[key] = asm
+                    log.info("[%s] Assembly for %s laid out from metadata (%d chunks, %d held)",
+                            device_hw_id, image_name, asm.total_chunks, asm.chunks_received)
+
+        # Early chunks replayed by relayout may already complete the image
+        if asm.is_complete():
+            submit_finalize(client, key, asm)
 
     except Exception as e:
         log.error("[%s] Failed to handle metadata: %s", device_hw_id, e)
@@ -683,7 +1070,8 @@ def handle_chunk(client: mqtt.Client, device_id: str, device_hw_id: str,
     b64_payload = msg.get("payload")
 
     # Log without payload
-    log_msg = {k: v for k, v in msg.items() if k != "payload"}
+    log_msg = msg.copy()
+    log_msg.pop("payload", None)
     log_msg["payload_length"] = len(b64_payload) if b64_payload else 0
     log_publish(device_id, topic, "in", log_msg)
 
@@ -693,15 +1081,83 @@ def handle_chunk(client: mqtt.Client, device_id: str, device_hw_id: str,
         return
 
     try:
-        chunk_bytes = base64.b64decode(b64_payload)
+        chunk_bytes = pybase64.b64decode(b64_payload, validate=False)
     except Exception as e:
         insert_error(device_id, None, 2103, "error", "chunk_b64_decode_error",
                     {"error": str(e), "chunk_id": chunk_id})
         return
 
+    store_chunk(client, device_id, device_hw_id, image_name, chunk_id, chunk_bytes, msg)
+
+
+def handle_binary_chunk(client: mqtt.Client, topic: str, msg: mqtt.MQTTMessage):
+    """
+    Handle raw binary image chunk (MQTT v5).
+
+    Topic: ESP32CAM/{MAC}/chunk/{chunk_id}
+    Payload: raw chunk bytes (no JSON envelope, no base64)
+    User properties:
+      img   - image name (required)
+      csz   - max chunk size (optional, used if chunk precedes metadata)
+      total - total chunk count (optional, used if chunk precedes metadata)
+    """
+    device_hw_id = extract_mac_from_topic(topic)
+    device_id = ensure_device(device_hw_id)
+
+    props = {}
+    if msg.properties is not None:
+        props = dict(getattr(msg.properties, "UserProperty", []))
+    image_name = props.get("img")
+
+    try:
+        chunk_id = int(topic.rsplit("/", 1)[1])
+    except ValueError:
+        chunk_id = None
+
+    log_publish(device_id, topic, "in", {
+        "image_name": image_name,
+        "chunk_id": chunk_id,
+        "payload_length": len(msg.payload)
+    })
+
+    if not image_name or chunk_id is None:
+        insert_error(device_id, None, 2104, "error", "chunk_bad_properties",
+                    {"topic": topic, "properties": props})
+        return
+    if not msg.payload:
+        insert_error(device_id, None, 2102, "warn", "chunk_missing_payload",
+                    {"image_name": image_name, "chunk_id": chunk_id})
+        return
+
+    hints = {}
+    if "csz" in props:
+        hints["max_chunk_size"] = int(props["csz"])
+    if "total" in props:
+        hints["total_chunks_count"] = int(props["total"])
+
+    store_chunk(client, device_id, device_hw_id, image_name, chunk_id, msg.payload, hints)
+
+
+def store_chunk(client: mqtt.Client, device_id: str, device_hw_id: str, image_name: str,
+                chunk_id: int, chunk_bytes: bytes, hints: dict):
+    """
+    Add decoded chunk bytes to the image assembly.
+
+    If no metadata has arrived yet, a minimal assembly and capture record are
+    created from `hints` (image_size, max_chunk_size, total_chunks_count).
+    Without both size hints the assembly only holds chunks until the metadata
+    lays it out.
+    """
     # Get or create assembly
     key = (device_hw_id, image_name)
-    if key not in assemblies:
+    with _assemblies_lock:
+        asm = assemblies.get(key)
+        finalized = asm is None and key in _recently_finalized
+    if finalized:
+        log.debug("[%s] Chunk %d for already finalized %s - dropped",
+                 device_hw_id, chunk_id, image_name)
+        return
+    if asm is None:
         # Chunk arrived before metadata - create minimal assembly
         log.warning("[%s] Chunk %d arrived before metadata for %s - creating minimal assembly",
                    device_hw_id, chunk_id, image_name)
@@ -710,54 +1166,76 @@ def handle_chunk(client: mqtt.Client, device_id: str, device_hw_id: str,
         try:
             capture_id, _ = upsert_capture_from_metadata(device_id, {
                 "image_name": image_name,
-                "image_size": msg.get("image_size"),
-                "max_chunks_size": msg.get("max_chunk_size", 1024),
-                "total_chunk_count": msg.get("total_chunks_count", chunk_id + 1),
+                "image_size": hints.get("image_size"),
+                "max_chunks_size": hints.get("max_chunk_size"),
+                "total_chunk_count": hints.get("total_chunks_count"),
                 "capture_timeStamp": now_iso()
             })
         except Exception as e:
             log.error("[%s] Failed to create minimal capture: %s", device_hw_id, e)
             return
 
-        assemblies[key] = ImageAssembly(
+        new_asm = ImageAssembly(
             device_hw_id=device_hw_id,
             image_name=image_name,
-            total_chunks=msg.get("total_chunks_count", chunk_id + 1),
-            chunk_size=msg.get("max_chunk_size", 1024),
-            declared_size=msg.get("image_size", 0)
+            total_chunks=hints.get("total_chunks_count"),
+            chunk_size=hints.get("max_chunk_size"),
+            declared_size=hints.get("image_size", 0)
         )
-        assemblies[key].capture_id = capture_id
-
-    # Add chunk to assembly
-    asm = assemblies[key]
+        new_asm.capture_id = capture_id
+        with _assemblies_lock:
+            asm = assemblies.setdefault(key, new_asm)
+        if asm is not new_asm:
+            # Metadata won the race while the capture row was being created
+            new_asm.release()
+
+    # Add chunk to assembly; finalize as soon as the last chunk lands
     asm.add_chunk(chunk_id, chunk_bytes)
+    if asm.is_complete():
+        submit_finalize(client, key, asm)
 
 
 # ------------ Assembly Finalization ------------
+def submit_finalize(client: mqtt.Client, key: Tuple[str, str], asm: ImageAssembly):
+    """
+    Remove a complete assembly from the active map and queue it on the
+    finalize pool. The finalize task owns the buffer from here on; if
+    another thread already claimed this assembly, do nothing.
+    """
+    with _assemblies_lock:
+        if assemblies.get(key) is not asm:
+            return
+        del assemblies[key]
+        _recently_finalized[key] = time.time() + FINALIZED_TTL_S
+    device_hw_id, image_name = key
+    _finalize_executor.submit(finalize_assembly_task, client, asm,
+                              device_hw_id, image_name)
+
+
 def try_finalize_assemblies(client: mqtt.Client):
     """
     Periodically scan all active assemblies:
-    - If complete: upload to storage, update DB, send ACK_OK
+    - If complete (fallback): hand off to the finalize pool
     - If incomplete & retry eligible: send NACK with missing chunks
     - If timed out: mark failed, clean up
     """
     now = time.time()
     to_delete = []
+    # device_hw_id -> {image_name: missing chunk IDs} for RLE-capable firmware
+    coalesced_nacks: Dict[str, Dict[str, list]] = {}
+
+    with _assemblies_lock:
+        active = list(assemblies.items())
+        for key in [k for k, until in _recently_finalized.items() if until <= now]:
+            del _recently_finalized[key]
 
-    for key, asm in list(assemblies.items()):
+    for key, asm in active:
         device_hw_id, image_name = key
 
-        # Check if complete
+        # Completion is normally handled in store_chunk; this catches any
+        # assembly that completed without going through it
         if asm.is_complete():
-            try:
-                finalize_complete_assembly(client, asm, device_hw_id, image_name)
-                to_delete.append(key)
-            except Exception as e:
-                log.error("[%s] Failed to finalize %s: %s", device_hw_id, image_name, e)
-                device_id = ensure_device(device_hw_id)
-                insert_error(device_id, asm.capture_id, 2200, "error",
-                           "finalization_failed", {"error": str(e)})
-                to_delete.append(key)
+            submit_finalize(client, key, asm)
             continue
 
         # Not complete - check for retry or timeout
@@ -766,7 +1244,10 @@ def try_finalize_assemblies(client: mqtt.Client):
         # Send NACK if eligible
         if (now - asm.last_nack_ts) * 1000 >= RETRANSMIT_DELAY_MS and asm.retries < RETRANSMIT_MAX:
             if missing:
-                publish_missing_chunks_nack(client, device_hw_id, image_name, missing)
+                if asm.nack_rle:
+                    coalesced_nacks.setdefault(device_hw_id, {})[image_name] = missing
+                else:
+                    publish_missing_chunks_nack(client, device_hw_id, image_name, missing)
                 asm.last_nack_ts = now
                 asm.retries += 1
 
@@ -785,28 +1266,54 @@ def try_finalize_assemblies(client: mqtt.Client):
 
             log.error("[%s] Assembly timeout for %s (%d chunks missing)",
                      device_hw_id, image_name, len(missing))
-            to_delete.append(key)
+            to_delete.append((key, asm))
+
+    # At most one coalesced NACK per device per tick
+    for device_hw_id, missing_by_image in coalesced_nacks.items():
+        publish_coalesced_nack(client, device_hw_id, missing_by_image)
 
-    # Clean up completed/failed assemblies
-    for key in to_delete:
-        assemblies.pop(key, None)
+    # Clean up failed assemblies; a message worker may be inside add_chunk on
+    # one of these, so the buffer is discarded rather than pooled
+    with _assemblies_lock:
+        for key, asm in to_delete:
+            if assemblies.get(key) is asm:
+                del assemblies[key]
+                asm.discard()
+
+
+def finalize_assembly_task(client: mqtt.Client, asm: ImageAssembly,
+                           device_hw_id: str, image_name: str):
+    """Run finalize_complete_assembly on the finalize pool and free the buffer."""
+    try:
+        finalize_complete_assembly(client, asm, device_hw_id, image_name)
+    except Exception as e:
+        log.error("[%s] Failed to finalize %s: %s", device_hw_id, image_name, e)
+        try:
+            device_id = ensure_device(device_hw_id)
+            insert_error(device_id, asm.capture_id, 2200, "error",
+                       "finalization_failed", {"error": str(e)})
+        except Exception as e2:
+            log.error("[%s] Failed to log finalization error: %s", device_hw_id, e2)
+    finally:
+        asm.release()
 
 
 def finalize_complete_assembly(client: mqtt.Client, asm: ImageAssembly,
                                device_hw_id: str, image_name: str):
     """
     Finalize a complete image assembly:
-    1. Concatenate chunks
-    2. Validate JPEG signature and size
+    1. View the assembled buffer
+    2. Validate JPEG signature and size, hash (no copy)
     3. Upload to Supabase Storage
     4. Update capture record
     5. Send ACK_OK to device
     """
     log.info("[%s] Finalizing complete assembly: %s", device_hw_id, image_name)
 
-    # Assemble image
-    img_bytes = asm.assemble_image()
-    actual_size = len(img_bytes)
+    # Validate and hash straight from the assembly buffer; the image is only
+    # copied out once it is known to be good and is about to be uploaded
+    img_view = asm.image_view()
+    actual_size = len(img_view)
 
     device_id = ensure_device(device_hw_id)
 
@@ -824,9 +1331,7 @@ def finalize_complete_assembly(client: mqtt.Client, asm: ImageAssembly,
         return  # Abort assembly
 
     # Validate JPEG signature (SOI: FF D8, EOI: FF D9)
-    if not (len(img_bytes) >= 4 and
-            img_bytes[0] == 0xFF and img_bytes[1] == 0xD8 and
-            img_bytes[-2] == 0xFF and img_bytes[-1] == 0xD9):
+    if actual_size < 4 or img_view[:2] != JPEG_SOI or img_view[-2:] != JPEG_EOI:
         log.error("[%s] Invalid JPEG signature for %s", device_hw_id, image_name)
         insert_error(device_id, asm.capture_id, 2203, "error", "invalid_jpeg_signature", {})
         # Mark capture as failed and abort
@@ -836,8 +1341,9 @@ def finalize_complete_assembly(client: mqtt.Client, asm: ImageAssembly,
         }).eq("capture_id", asm.capture_id).execute()
         return  # Abort assembly
 
-    # Calculate SHA256
-    img_sha = sha256_hex(img_bytes)
+    # Calculate SHA256 (hashlib takes the buffer directly)
+    img_sha = sha256_hex(img_view)
+    img_bytes = img_view.tobytes()
 
     # Upload to Supabase Storage
     # Path: captures/{device_hw_id}/YYYY/MM/DD/{image_name}
@@ -845,11 +1351,7 @@ def finalize_complete_assembly(client: mqtt.Client, asm: ImageAssembly,
     storage_path = f"captures/{device_hw_id}/{ymd}/{image_name}"
 
     try:
-        sb.storage.from_(STORAGE_BUCKET).upload(
-            storage_path,
-            img_bytes,
-            {"content-type": "image/jpeg", "x-upsert": "true"}
-        )
+        upload_image(storage_path, img_bytes)
         log.info("[%s] Uploaded to storage: %s (%d bytes)", device_hw_id, storage_path, actual_size)
     except Exception as e:
         insert_error(device_id, asm.capture_id, 2204, "error", "storage_upload_failed",
@@ -865,79 +1367,149 @@ def finalize_complete_assembly(client: mqtt.Client, asm: ImageAssembly,
         log.warning("[%s] Failed to generate public URL: %s", device_hw_id, e)
         image_url = None
 
-    # Update capture record with SUCCESS status
-    try:
-        update_data = {
-            "ingest_status": "success",  # Changed from "stored" to "success"
-            "storage_path": storage_path,
-            "image_sha256": img_sha,
-            "image_bytes": actual_size
-        }
-
-        # Only add image_url if we got one
-        if image_url:
-            update_data["image_url"] = image_url
-
-        sb.table("captures").update(update_data).eq("capture_id", asm.capture_id).execute()
-        log.info("[%s] Capture finalized: %s (status=success, %d bytes, sha256=%s)",
-                device_hw_id, asm.capture_id, actual_size, img_sha[:16])
-    except Exception as e:
-        insert_error(device_id, asm.capture_id, 2205, "error", "capture_update_failed",
-                    {"error": str(e)})
-        raise
-
-    # Send ACK_OK to device
-    publish_ack_ok(client, device_hw_id, image_name)
+    # Mark the capture stored in the next batched write; ACK_OK follows it
+    queue_capture_update(device_id, device_hw_id, image_name, {
+        "capture_id": asm.capture_id,
+        "st": "success",
+        "sp": storage_path,
+        "sha": img_sha,
+        "sz": actual_size,
+        "url": image_url
+    })
 
 
 # ------------ MQTT Client Lifecycle ------------
-running = True
+# Set by signal_handler; the main loop waits on it instead of sleeping so
+# shutdown is picked up immediately rather than on the next tick
+shutdown_event = threading.Event()
+
+# Set on shutdown, on device_commands NOTIFY and when a capture update is
+# queued, to end the main loop's wait early
+loop_wakeup = threading.Event()
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully."""
-    global running
     log.info("Shutdown signal received")
-    running = False
+    shutdown_event.set()
+    loop_wakeup.set()
+
+
+def make_tls_context() -> ResumingSSLContext:
+    """Verifying client context, equivalent to tls_set(cert_reqs=CERT_REQUIRED)."""
+    ctx = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.load_default_certs()
+    return ctx
+
+
+# Built once so the CA store is loaded once and the session survives reconnects
+_tls_context = make_tls_context() if MQTT_TLS else None
+
+
+def on_socket_open(client, userdata, sock):
+    """Disable Nagle before CONNECT so small PUBLISH/ACK frames go out immediately."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
 def on_connect(client, userdata, flags, rc, properties=None):
     """MQTT connection callback."""
     if rc == 0:
         log.info("✓ MQTT connected successfully")
+        # Keep the session for the next reconnect (TLS 1.3 tickets arrive
+        # after the handshake, so it is read here rather than on socket open)
+        sock = client.socket()
+        if _tls_context is not None and isinstance(sock, ssl.SSLSocket):
+            log.debug("TLS session reused: %s", sock.session_reused)
+            _tls_context.tls_session = sock.session
         # Subscribe to device topics
         client.subscribe(TOPIC_PATTERN_STATUS, qos=1)
         client.subscribe(TOPIC_PATTERN_DATA, qos=1)
         client.subscribe(TOPIC_PATTERN_ACK, qos=1)
+        client.subscribe(TOPIC_PATTERN_CHUNK, qos=1)
         log.info("✓ Subscribed to topics:")
         log.info("  - %s", TOPIC_PATTERN_STATUS)
         log.info("  - %s", TOPIC_PATTERN_DATA)
         log.info("  - %s", TOPIC_PATTERN_ACK)
+        log.info("  - %s", TOPIC_PATTERN_CHUNK)
     else:
-        log.error("✗ MQTT connection failed with code %d", rc)
+        log.error("✗ MQTT connection failed with code %s", rc)
 
 
-def on_disconnect(client, userdata, rc, properties=None):
+def on_disconnect(client, userdata, flags, rc, properties=None):
     """MQTT disconnection callback."""
     if rc != 0:
-        log.warning("✗ MQTT disconnected unexpectedly (rc=%d) - will auto-reconnect", rc)
+        log.warning("✗ MQTT disconnected unexpectedly (rc=%s) - will auto-reconnect", rc)
     else:
         log.info("✓ MQTT disconnected cleanly")
 
 
+# One bounded queue per message worker. Messages are routed by device so
+# each device's metadata and chunks are handled in order by a single thread.
+_message_queues: List[queue.Queue] = []
+_message_workers: List[threading.Thread] = []
+
+
+def start_message_workers(client: mqtt.Client):
+    """Start MESSAGE_WORKERS threads draining the inbound message queues."""
+    per_queue = max(MESSAGE_QUEUE_MAX // MESSAGE_WORKERS, 1)
+    for i in range(MESSAGE_WORKERS):
+        q = queue.Queue(maxsize=per_queue)
+        t = threading.Thread(target=message_worker, args=(client, q),
+                             name=f"msg-worker-{i}", daemon=True)
+        _message_queues.append(q)
+        _message_workers.append(t)
+        t.start()
+
+
+def stop_message_workers():
+    """Ask message workers to exit after draining their queues, then join."""
+    for q in _message_queues:
+        q.put(None)
+    for t in _message_workers:
+        t.join()
+
+
+def message_worker(client: mqtt.Client, q: queue.Queue):
+    """Handle queued MQTT messages until a None sentinel is received."""
+    while True:
+        msg = q.get()
+        if msg is None:
+            return
+        dispatch_message(client, msg)
+
+
 def on_message(client, userdata, msg: mqtt.MQTTMessage):
-    """MQTT message callback - route to appropriate handler."""
+    """
+    MQTT message callback - enqueue for a message worker.
+
+    Runs on the Paho network thread, so no parsing or DB work happens here.
+    If the worker queue is full the message is dropped; devices recover
+    missing chunks via NACK/retransmit.
+    """
+    device_hw_id = extract_mac_from_topic(msg.topic)
+    q = _message_queues[hash(device_hw_id) % len(_message_queues)]
+    try:
+        q.put_nowait(msg)
+    except queue.Full:
+        log.warning("[%s] Message queue full - dropping message on %s",
+                   device_hw_id, msg.topic)
+
+
+def dispatch_message(client: mqtt.Client, msg: mqtt.MQTTMessage):
+    """Route an MQTT message to the appropriate handler."""
     topic = msg.topic
+    device_hw_id, kind = split_topic(topic)
 
     try:
-        if "/status" in topic:
+        if kind == "chunk":
+            handle_binary_chunk(client, topic, msg)
+        elif kind == "status":
             handle_status_message(client, topic, msg.payload)
-        elif "/data" in topic:
+        elif kind == "data":
             handle_data_message(client, topic, msg.payload)
-        elif "/ack" in topic:
+        elif kind == "ack":
             # Device->server ack (if firmware uses this); just log for now
-            device_hw_id = extract_mac_from_topic(topic)
             try:
-                payload = json.loads(msg.payload.decode("utf-8"))
+                payload = orjson.loads(msg.payload)
                 log.debug("[%s] ACK received: %s", device_hw_id, payload)
             except Exception:
                 pass
@@ -945,34 +1517,86 @@ def on_message(client, userdata, msg: mqtt.MQTTMessage):
         log.error("Error handling message on %s: %s", topic, e)
 
 
+# ------------ Command Dispatch ------------
+# A trigger on device_commands NOTIFYs each queued insert (see
+# add_command_notify_trigger.sql). The listener thread only flags that
+# commands are waiting; the main loop still reads and sends them, and falls
+# back to a COMMAND_POLL_INTERVAL_S poll in case a notification is missed.
+commands_notified = threading.Event()
+
+
+def command_listener():
+    """LISTEN for queued commands until shutdown, reconnecting on errors."""
+    while not shutdown_event.is_set():
+        try:
+            # No server-side prepared statements, so the URL may point at Supavisor
+            with psycopg.connect(SUPABASE_DB_URL, autocommit=True,
+                                 prepare_threshold=None) as conn:
+                conn.execute("LISTEN device_command_queued")
+                log.info("✓ Listening for device_commands notifications")
+                # Anything inserted while disconnected was not notified
+                commands_notified.set()
+                loop_wakeup.set()
+                while not shutdown_event.is_set():
+                    for _ in conn.notifies(timeout=1.0, stop_after=1):
+                        commands_notified.set()
+                        loop_wakeup.set()
+        except Exception as e:
+            log.warning("Command listener error, reconnecting: %s", e)
+            shutdown_event.wait(5)
+
+
+def start_command_listener() -> bool:
+    """Start the LISTEN thread if a database URL is configured."""
+    if not SUPABASE_DB_URL:
+        return False
+    if psycopg is None:
+        log.warning("SUPABASE_DB_URL is set but psycopg is not installed; polling commands")
+        return False
+    # Supavisor transaction mode hands the server connection back after each
+    # statement, so the LISTEN would be silently dropped
+    if urlparse(SUPABASE_DB_URL).port == 6543:
+        log.warning("SUPABASE_DB_URL uses the transaction pooler (6543); LISTEN needs "
+                    "session mode (5432). Polling commands instead")
+        return False
+    threading.Thread(target=command_listener, name="cmd-listener", daemon=True).start()
+    return True
+
+
 def poll_and_send_commands(client: mqtt.Client):
     """
-    Poll device_commands table for queued commands and send via MQTT.
+    Claim queued device_commands and send them via MQTT.
 
     Command types from firmware:
     - capture_image: Trigger immediate capture
     - send_image: Request device to send specific image
+
+    Claiming marks a command 'sent'. A command that cannot be built is then
+    marked 'failed' with a log row; one whose publish raises goes back to
+    'queued' for the next poll.
     """
+    failed = {}  # command_id -> (device_id, reason)
+    requeue = []
     try:
-        # Query for queued commands
-        result = sb.table("device_commands")\
-            .select("command_id, device_id, command_type, command_payload, devices(device_hw_id)")\
-            .eq("status", "queued")\
-            .order("requested_at")\
-            .limit(10)\
-            .execute()
+        # One round-trip marks up to COMMAND_CLAIM_LIMIT commands sent; SKIP
+        # LOCKED keeps concurrent workers from claiming the same rows
+        result = sb.rpc("claim_queued_commands", {"_limit": COMMAND_CLAIM_LIMIT}).execute()
 
         if not result.data:
             return  # No queued commands
 
+        # A full batch may have left more behind; claim again next tick
+        if len(result.data) >= COMMAND_CLAIM_LIMIT:
+            commands_notified.set()
+
         for cmd_row in result.data:
             command_id = cmd_row["command_id"]
             device_id = cmd_row["device_id"]
             command_type = cmd_row["command_type"]
-            command_payload = cmd_row.get("command_payload", {})
+            command_payload = cmd_row.get("command_payload") or {}
 
             # Get device MAC address
-            device_hw_id = cmd_row["devices"]["device_hw_id"]
+            device_hw_id = cmd_row["device_hw_id"]
 
             # Build command topic
             cmd_topic = f"ESP32CAM/{device_hw_id}/cmd"
@@ -986,7 +1610,8 @@ def poll_and_send_commands(client: mqtt.Client):
             elif command_type == "send_image":
                 image_name = command_payload.get("image_name")
                 if not image_name:
-                    log.warning("send_image command missing image_name, skipping")
+                    log.warning("send_image command %s missing image_name, skipping", command_id)
+                    failed[command_id] = (device_id, "missing image_name")
                     continue
                 message = {
                     "device_id": device_hw_id,
@@ -995,7 +1620,8 @@ def poll_and_send_commands(client: mqtt.Client):
             elif command_type == "next_wake":
                 wake_time = command_payload.get("wake_time")
                 if not wake_time:
-                    log.warning("next_wake command missing wake_time, skipping")
+                    log.warning("next_wake command %s missing wake_time, skipping", command_id)
+                    failed[command_id] = (device_id, "missing wake_time")
                     continue
                 message = {
                     "device_id": device_hw_id,
@@ -1003,33 +1629,44 @@ def poll_and_send_commands(client: mqtt.Client):
                 }
             else:
                 log.warning("Unknown command type: %s, skipping", command_type)
+                failed[command_id] = (device_id, f"unknown command type: {command_type}")
                 continue
 
             # Publish command to device
             try:
-                client.publish(cmd_topic, json.dumps(message), qos=1)
+                client.publish(cmd_topic, orjson.dumps(message), qos=1)
                 log.info("[%s] Command sent: %s", device_hw_id, command_type)
-
-                # Update command status to 'sent'
-                sb.table("device_commands").update({
-                    "status": "sent",
-                    "sent_at": now_iso()
-                }).eq("command_id", command_id).execute()
-
-                # Log to device_command_logs
-                sb.table("device_command_logs").insert({
+                queue_insert("device_command_logs", {
                     "command_id": command_id,
                     "device_id": device_id,
                     "event_type": "sent",
                     "event_payload": {"message": message, "topic": cmd_topic}
-                }).execute()
-
+                })
             except Exception as e:
                 log.error("Failed to send command %s: %s", command_id, e)
+                requeue.append(command_id)
 
     except Exception as e:
         log.error("Error polling commands: %s", e)
 
+    # Undo the claim's 'sent' for commands that never reached the device
+    try:
+        if failed:
+            sb.table("device_commands").update({"status": "failed"})\
+                .in_("command_id", list(failed)).execute()
+            for command_id, (device_id, reason) in failed.items():
+                queue_insert("device_command_logs", {
+                    "command_id": command_id,
+                    "device_id": device_id,
+                    "event_type": "failed",
+                    "event_payload": {"error": reason}
+                })
+        if requeue:
+            sb.table("device_commands").update({"status": "queued", "sent_at": None})\
+                .in_("command_id", requeue).execute()  # picked up by the next poll
+    except Exception as e:
+        log.error("Failed to reset unsent commands: %s", e)
+
 
 def main():
     """Main worker loop."""
@@ -1041,6 +1678,7 @@ def main():
     log.info("GXP MQTT Worker - ESP32S3-CAM Fleet Ingestion")
     log.info("=" * 60)
     log.info("MQTT Broker: %s:%d (TLS: %s)", MQTT_HOST, MQTT_PORT, MQTT_TLS)
+    log.info("MQTT Client ID: %s (session expiry: %ds)", MQTT_CLIENT_ID, MQTT_SESSION_EXPIRY_S)
     log.info("Supabase: %s", SUPABASE_URL)
     log.info("Storage Bucket: %s", STORAGE_BUCKET)
     log.info("=" * 60)
@@ -1048,26 +1686,40 @@ def main():
     # Create MQTT client
     client = mqtt.Client(
         mqtt.CallbackAPIVersion.VERSION2,
-        client_id=f"gxp-worker-{int(time.time())}"
+        client_id=MQTT_CLIENT_ID,
+        protocol=mqtt.MQTTv5  # needed for user properties on binary chunks
     )
 
+    # Widen the QoS-1 window in both directions; the default of 20 caps
+    # chunk throughput when broker RTT is non-trivial
+    client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    client.max_queued_messages_set(0)  # unbounded
+    connect_props = Properties(PacketTypes.CONNECT)
+    connect_props.SessionExpiryInterval = MQTT_SESSION_EXPIRY_S
+    connect_props.ReceiveMaximum = MQTT_MAX_INFLIGHT
+
     # Configure TLS if enabled
-    if MQTT_TLS:
-        client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
+    if _tls_context is not None:
+        client.tls_set_context(_tls_context)
 
     # Set credentials
     if MQTT_USERNAME and MQTT_PASSWORD:
         client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
     # Set callbacks
+    client.on_socket_open = on_socket_open
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
 
+    # Start message workers before any message can arrive
+    start_message_workers(client)
+
     # Connect
     try:
         log.info("Connecting to MQTT broker...")
-        client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
+        client.connect(MQTT_HOST, MQTT_PORT, keepalive=60,
+                       clean_start=False, properties=connect_props)
     except Exception as e:
         log.error("Failed to connect to MQTT broker: %s", e)
         return 1
@@ -1075,23 +1727,44 @@ def main():
     # Start MQTT loop in background thread
     client.loop_start()
 
+    # With LISTEN, commands are read on notification plus a slow keepalive poll
+    command_poll_interval = COMMAND_POLL_INTERVAL_S if start_command_listener() else 0
+    next_command_poll = 0.0
+
     # Main processing loop
     try:
         log.info("✓ Worker started - processing messages...")
-        while running:
+        while not shutdown_event.is_set():
+            # Mark finalized captures stored, then ACK them; first, so an
+            # update that woke the loop is not held behind the sweep below
+            flush_capture_updates(client)
+
             # Periodically check assemblies for completion/retry/timeout
             try_finalize_assemblies(client)
 
-            # Poll and send queued commands
-            poll_and_send_commands(client)
+            # Send queued commands when notified or when the poll is due
+            now = time.monotonic()
+            if commands_notified.is_set() or now >= next_command_poll:
+                commands_notified.clear()
+                poll_and_send_commands(client)
+                next_command_poll = now + command_poll_interval
+
+            # Write queued status/log/error rows
+            flush_pending_inserts()
 
-            time.sleep(0.5)
+            loop_wakeup.wait(0.5)
+            loop_wakeup.clear()
     except Exception as e:
         log.error("Unexpected error in main loop: %s", e)
     finally:
         log.info("Shutting down...")
+        stop_message_workers()
+        _finalize_executor.shutdown(wait=True)  # let in-flight uploads finish
+        flush_capture_updates(client)
         client.loop_stop()
         client.disconnect()
+        flush_pending_inserts()
+        _storage_http.close()
         log.info("✓ Shutdown complete")
 
     return 0
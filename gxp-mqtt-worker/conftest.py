@@ -0,0 +1,30 @@
+"""
+pytest fixtures for the device-simulating test scripts.
+
+Run against a live worker and broker, e.g.:
+    pytest -n 5 test_error_codes.py test_invalid_jpeg.py
+"""
+from pathlib import Path
+import pytest
+import mqtt_session
+import supabase_session
+
+# Only these modules are written for pytest. The other test_*.py files are
+# standalone scripts (test_jsonb_schema.py inserts rows and exits at import),
+# so a bare `pytest` must not collect them.
+PYTEST_MODULES = {"test_error_codes.py", "test_invalid_jpeg.py"}
+collect_ignore = [path.name for path in Path(__file__).parent.glob("test_*.py")
+                  if path.name not in PYTEST_MODULES]
+
+
+@pytest.fixture(scope="module")
+def mqtt_client():
+    """Connected, subscribed client shared by every case in a module (and,
+    through mqtt_session, by every module in the same worker process)."""
+    return mqtt_session.get_client()
+
+
+@pytest.fixture(scope="session")
+def supabase_client():
+    """Keep-alive Supabase client shared by every test in the process."""
+    return supabase_session.get_supabase()
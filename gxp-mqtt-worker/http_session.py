@@ -0,0 +1,31 @@
+"""
+Keep-alive HTTP session for Supabase clients.
+
+Used by the worker (app.make_supabase_client) and by the test scripts
+(supabase_session.get_supabase); each passes its own pool size and timeouts.
+"""
+import httpx
+from postgrest.utils import SyncClient
+from supabase import Client
+
+
+def use_keepalive_session(client: Client, limits: httpx.Limits,
+                          timeout: httpx.Timeout) -> Client:
+    """
+    Swap the client's PostgREST session for an HTTP/2 one with these limits
+    and timeouts, keeping its base URL and headers. httpx drops idle
+    connections after 5s by default; a longer keepalive_expiry lets requests
+    after a quiet spell skip the TCP+TLS handshake.
+    """
+    rest = client.postgrest
+    default_session = rest.session
+    rest.session = SyncClient(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        limits=limits,
+        timeout=timeout,
+        follow_redirects=True,
+        http2=True
+    )
+    default_session.close()
+    return client
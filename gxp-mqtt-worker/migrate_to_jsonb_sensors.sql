@@ -18,9 +18,10 @@ WHERE c.capture_id = sr.capture_id
   AND c.sensor_data = '{}';
 
 -- Step 3: Create indexes for common sensor queries
--- GIN index for flexible JSON queries (e.g., searching multiple fields)
+-- GIN index for containment queries (sensor_data @> '{"temperature_c": 25.5}');
+-- jsonb_path_ops is about half the size of the default jsonb_ops and faster for @>
 CREATE INDEX IF NOT EXISTS idx_captures_sensor_data_gin
-ON public.captures USING GIN (sensor_data);
+ON public.captures USING GIN (sensor_data jsonb_path_ops);
 
 -- B-tree indexes for specific numeric queries (faster for ranges/comparisons)
 CREATE INDEX IF NOT EXISTS idx_captures_temperature
@@ -79,6 +80,18 @@ EXECUTE FUNCTION validate_sensor_data();
 COMMENT ON COLUMN public.captures.sensor_data IS 'Environmental sensor data from BME680: temperature_c, humidity_pct, pressure_hpa, gas_kohm';
 
 -- Step 6: Create helpful views for common queries
+-- Skipped once add_captures_with_sensors_matview.sql has replaced the view
+-- with a materialized view, so this migration can be re-run
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM pg_matviews
+    WHERE schemaname = 'public' AND matviewname = 'captures_with_sensors'
+  ) THEN
+    RETURN;
+  END IF;
+
+  EXECUTE $view$
 CREATE OR REPLACE VIEW captures_with_sensors AS
 SELECT
   c.capture_id,
@@ -97,9 +110,12 @@ SELECT
   (c.sensor_data->>'gas_kohm')::numeric as gas_kohm,
   c.sensor_data,
   c.created_at
-FROM public.captures c;
+FROM public.captures c
+  $view$;
 
-COMMENT ON VIEW captures_with_sensors IS 'Captures with sensor data extracted as columns for easy querying';
+  COMMENT ON VIEW captures_with_sensors IS 'Captures with sensor data extracted as columns for easy querying';
+END;
+$$;
 
 -- Step 7: Verification queries (run after migration)
 -- Uncomment to verify migration success:
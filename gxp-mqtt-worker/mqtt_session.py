@@ -0,0 +1,136 @@
+"""
+Shared MQTT connection for the device-simulating test scripts.
+
+get_client() connects once per process (TLS + CONNECT + SUBACK for
+ESP32CAM/+/ack) and hands the same client to every caller, so running
+several scripts from one process pays the handshake only once. Scripts
+register per-topic ACK handlers with add_handler() instead of replacing
+client.on_message. Scripts that need their own clients use TLS_CONTEXT and
+on_socket_open from here; setup_logging() moves their console output off the
+network thread.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import socket
+import ssl
+import threading
+from dotenv import load_dotenv
+import paho.mqtt.client as mqtt
+from tls_session import ResumingSSLContext
+
+load_dotenv()
+
+MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
+MQTT_USERNAME = os.getenv("MQTT_USERNAME")
+MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+MQTT_TEST_CLIENT_ID = os.getenv("MQTT_TEST_CLIENT_ID", f"gxp-test-{os.getpid()}")
+
+ACK_TOPIC = "ESP32CAM/+/ack"
+
+# Built once so the CA store is loaded once and the session survives
+# reconnects; verifies the broker certificate and hostname like the worker.
+# Pin TLS 1.2 negotiation to ECDHE + AES-GCM so record crypto takes the
+# AES-NI path; TLS 1.3 suites are AEAD-only already and unaffected by
+# set_ciphers().
+TLS_CONTEXT = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+TLS_CONTEXT.load_default_certs()
+TLS_CONTEXT.set_ciphers("ECDHE+AESGCM")
+
+def setup_logging(name):
+    """Configure logging at LOG_LEVEL with a QueueListener thread doing the
+    stdout writes, so paho callbacks and the publish path only enqueue
+    records. Returns (logger, listener); stop the listener to flush queued
+    output before printing a summary."""
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s",
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return logging.getLogger(name), listener
+
+_client = None
+_client_lock = threading.Lock()
+_subscribed = threading.Event()
+_handlers = []  # [(topic_prefix, callback)]
+_handlers_lock = threading.Lock()
+
+def add_handler(topic_prefix, callback):
+    """Route messages whose topic starts with topic_prefix to callback(client, userdata, msg)"""
+    with _handlers_lock:
+        _handlers.append((topic_prefix, callback))
+
+def remove_handler(topic_prefix, callback):
+    with _handlers_lock:
+        _handlers.remove((topic_prefix, callback))
+
+def on_socket_open(client, userdata, sock):
+    # Disable Nagle so small PUBLISH frames are not held back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def remember_tls_session(client):
+    """Keep the connection's TLS session for the next connect through TLS_CONTEXT.
+    Call from on_connect: TLS 1.3 tickets arrive after the handshake."""
+    sock = client.socket()
+    if isinstance(sock, ssl.SSLSocket):
+        TLS_CONTEXT.tls_session = sock.session
+
+def _on_connect(client, userdata, flags, rc, properties=None):
+    if rc == 0:
+        print(f"✓ Connected!")
+        remember_tls_session(client)
+        # Re-subscribe on every (re)connect; one wildcard covers all test devices
+        client.subscribe(ACK_TOPIC, qos=1)
+    else:
+        print(f"✗ Connection failed: {rc}")
+
+def _on_subscribe(client, userdata, mid, reason_code_list, properties):
+    _subscribed.set()
+
+def _on_message(client, userdata, msg):
+    with _handlers_lock:
+        handlers = [cb for prefix, cb in _handlers if msg.topic.startswith(prefix)]
+    for callback in handlers:
+        callback(client, userdata, msg)
+
+def get_client(timeout=10):
+    """Return the shared client, connecting and subscribing on first use"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_TEST_CLIENT_ID,
+                             protocol=mqtt.MQTTv5)  # user properties on binary chunks
+        client.tls_set_context(TLS_CONTEXT)
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        client.on_socket_open = on_socket_open
+        client.on_connect = _on_connect
+        client.on_subscribe = _on_subscribe
+        client.on_message = _on_message
+
+        print(f"\nConnecting to {MQTT_HOST}:{MQTT_PORT}...")
+        client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
+        client.loop_start()
+
+        if not _subscribed.wait(timeout):
+            client.loop_stop()
+            raise RuntimeError(f"No SUBACK from broker within {timeout}s")
+
+        _client = client
+        atexit.register(close)
+        return _client
+
+def close():
+    """Disconnect the shared client; the next get_client() reconnects"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            return
+        _client.disconnect()
+        _client.loop_stop()
+        _client = None
+        _subscribed.clear()
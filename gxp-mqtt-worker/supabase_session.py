@@ -0,0 +1,59 @@
+"""
+Shared Supabase client for the test scripts.
+
+get_supabase() builds one client per process with a keep-alive HTTP/2
+PostgREST session (http_session.use_keepalive_session, as the worker does),
+so consecutive queries reuse one TLS connection instead of reconnecting. get_device_id() resolves test devices by MAC once
+per process; wait_for_device_error() lets a test confirm the worker logged
+an error rather than only that it sent no ACK.
+"""
+import os
+import time
+from functools import lru_cache
+import httpx
+from dotenv import load_dotenv
+from supabase import create_client, Client
+from http_session import use_keepalive_session
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE")
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    """Return the shared client, creating it on first use"""
+    return use_keepalive_session(
+        create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE),
+        httpx.Limits(max_connections=20, max_keepalive_connections=10,
+                     keepalive_expiry=60),
+        httpx.Timeout(10.0, connect=5.0)
+    )
+
+@lru_cache(maxsize=128)
+def get_device_id(device_hw_id: str) -> str:
+    """Resolve a MAC to its device_id, creating the device if needed"""
+    # One upsert_device RPC round-trip (add_upsert_device_rpc.sql) per MAC
+    # per process; repeats come from the cache
+    return get_supabase().rpc("upsert_device", {"_hw_id": device_hw_id}).execute().data
+
+def count_device_errors(client: Client, device_hw_id: str, error_code: int) -> int:
+    """Number of device_errors rows with this code for a test device"""
+    return client.table("device_errors") \
+        .select("error_code", count="exact") \
+        .eq("device_id", get_device_id(device_hw_id)) \
+        .eq("error_code", error_code) \
+        .limit(1) \
+        .execute().count
+
+def wait_for_device_error(client: Client, device_hw_id: str, error_code: int,
+                          baseline: int, timeout: float) -> bool:
+    """Poll until the device has more than `baseline` errors with this code.
+    Counting instead of filtering on time keeps rows from earlier runs (and
+    clock skew against the database) out of the result."""
+    deadline = time.monotonic() + timeout
+    while count_device_errors(client, device_hw_id, error_code) <= baseline:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.25)
+    return True
@@ -19,28 +19,34 @@ Test scenarios:
 - Scenario B: send_image command with filename
 - Scenario C: Multiple commands for same device (queue processing)
 """
-import json
+import logging
+import orjson
+import threading
 import time
+import uuid
 import os
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
-import ssl
-from supabase import create_client
+import mqtt_session
+from supabase_session import get_supabase, get_device_id
 
 load_dotenv()
 
+# LOG_LEVEL=DEBUG adds each received command's payload as indented JSON
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+log = logging.getLogger(__name__)
+
 MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE")
-
 TEST_MAC = "CMDTEST01"
 
 # Commands received tracker
 commands_received = []
+cmd_event = threading.Event()  # set by on_message after each command
+subscribed = threading.Event()  # set on SUBACK for the cmd topic
 
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
@@ -48,62 +54,64 @@ def on_connect(client, userdata, flags, rc, properties=None):
         # Subscribe to cmd topic (simulating ESP32 device)
         client.subscribe(f"ESP32CAM/{TEST_MAC}/cmd")
         print(f"✓ Subscribed to ESP32CAM/{TEST_MAC}/cmd (simulating ESP32)")
-        time.sleep(1)
     else:
         print(f"✗ Connection failed: {rc}")
 
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    subscribed.set()
+
+def wait_for_commands(count: int, timeout: float = 5.0) -> bool:
+    """Block until `count` commands in total have arrived, or timeout"""
+    deadline = time.monotonic() + timeout
+    while len(commands_received) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not cmd_event.wait(remaining):
+            return False
+        cmd_event.clear()
+    return True
+
 def on_message(client, userdata, msg):
     """Handle commands received (simulating ESP32 firmware)"""
     global commands_received
 
-    print(f"\n📩 Command received on {msg.topic}:")
+    log.info("\n📩 Command received on %s", msg.topic)
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
         commands_received.append(payload)
+        cmd_event.set()
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
 
         # Simulate firmware behavior
         if "capture_image" in payload:
-            print("  → ESP32 would: Capture image + sensor data, store on SD card")
+            log.info("  → ESP32 would: Capture image + sensor data, store on SD card")
         elif "send_image" in payload:
-            image_name = payload.get("send_image")
-            print(f"  → ESP32 would: Send image '{image_name}' in chunks")
+            log.info("  → ESP32 would: Send image '%s' in chunks", payload.get("send_image"))
         elif "next_wake" in payload:
-            wake_time = payload.get("next_wake")
-            print(f"  → ESP32 would: Set RTC timer for {wake_time}, enter deep sleep")
+            log.info("  → ESP32 would: Set RTC timer for %s, enter deep sleep", payload.get("next_wake"))
 
     except Exception as e:
-        print(f"Error parsing command: {e}")
+        log.error("Error parsing command: %s", e)
 
-def insert_command(sb, device_id: str, command_type: str, command_payload: dict = None):
-    """Insert command into device_commands table"""
-    cmd_data = {
+def command_row(device_id: str, command_type: str, command_payload: dict = None):
+    """Build a queued device_commands row"""
+    return {
+        "command_id": str(uuid.uuid4()),  # client-side, so inserts need no response body
         "device_id": device_id,
         "command_type": command_type,
         "command_payload": command_payload or {},
         "status": "queued"
     }
-    result = sb.table("device_commands").insert(cmd_data).execute()
-    return result.data[0] if result.data else None
-
-def ensure_test_device(sb, device_hw_id: str):
-    """Ensure test device exists in database"""
-    # Check if device exists
-    result = sb.table("devices")\
-        .select("device_id")\
-        .eq("device_hw_id", device_hw_id)\
-        .execute()
-
-    if result.data:
-        return result.data[0]["device_id"]
 
-    # Create device
-    ins = sb.table("devices").insert({
-        "device_hw_id": device_hw_id,
-        "model": "ESP32S3-CAM"
-    }).execute()
+def insert_command(sb, device_id: str, command_type: str, command_payload: dict = None):
+    """Insert command into device_commands table"""
+    return insert_commands(sb, [command_row(device_id, command_type, command_payload)])[0]
 
-    return ins.data[0]["device_id"]
+def insert_commands(sb, rows: list):
+    """Insert several commands in one request and return the rows as sent"""
+    sb.table("device_commands").insert(rows, returning="minimal").execute()
+    return rows
 
 def main():
     print("="*70)
@@ -112,26 +120,31 @@ def main():
 
     # Initialize Supabase
     print(f"\n🔌 Connecting to Supabase...")
-    sb = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE)
+    sb = get_supabase()
 
     # Ensure test device exists
     print(f"📱 Ensuring test device exists: {TEST_MAC}")
-    device_id = ensure_test_device(sb, TEST_MAC)
+    device_id = get_device_id(TEST_MAC)
     print(f"   Device ID: {device_id}")
 
     # Connect MQTT (simulating ESP32 device)
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="test-esp32-cmd")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
+    # Shared context: verifies the broker like the worker, resumes TLS sessions
+    client.tls_set_context(mqtt_session.TLS_CONTEXT)
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     client.on_connect = on_connect
+    client.on_socket_open = mqtt_session.on_socket_open
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
 
     print(f"\n🔌 Connecting to MQTT broker...")
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
     client.loop_start()
 
-    time.sleep(2)
+    if not subscribed.wait(timeout=10):
+        print(f"✗ No SUBACK from broker within 10s")
+        client.loop_stop()
+        return
 
     # Scenario A: capture_image command
     print(f"\n{'='*70}")
@@ -144,7 +157,7 @@ def main():
     print(f"   Status: {cmd1['status']}")
 
     print(f"\n⏳ Waiting for worker to poll and send command...")
-    time.sleep(3)
+    wait_for_commands(1)
 
     # Scenario B: send_image command
     print(f"\n{'='*70}")
@@ -157,7 +170,7 @@ def main():
     print(f"   Image Name: test_001.jpg")
 
     print(f"\n⏳ Waiting for worker to poll and send command...")
-    time.sleep(3)
+    wait_for_commands(2)
 
     # Scenario C: Multiple commands
     print(f"\n{'='*70}")
@@ -165,9 +178,11 @@ def main():
     print(f"{'='*70}")
 
     print(f"\n3️⃣  Inserting 3 commands in rapid succession...")
-    cmd3a = insert_command(sb, device_id, "capture_image")
-    cmd3b = insert_command(sb, device_id, "send_image", {"image_name": "test_002.jpg"})
-    cmd3c = insert_command(sb, device_id, "send_image", {"image_name": "test_003.jpg"})
+    cmd3a, cmd3b, cmd3c = insert_commands(sb, [
+        command_row(device_id, "capture_image"),
+        command_row(device_id, "send_image", {"image_name": "test_002.jpg"}),
+        command_row(device_id, "send_image", {"image_name": "test_003.jpg"}),
+    ])
 
     print(f"   Commands inserted:")
     print(f"     - {cmd3a['command_id']}: capture_image")
@@ -175,11 +190,7 @@ def main():
     print(f"     - {cmd3c['command_id']}: send_image (test_003.jpg)")
 
     print(f"\n⏳ Waiting for worker to process queue...")
-    time.sleep(5)
-
-    # Final wait for any remaining commands
-    print(f"\n⏳ Final wait for command processing...")
-    time.sleep(2)
+    wait_for_commands(5, timeout=10)
 
     client.loop_stop()
     client.disconnect()
@@ -191,7 +202,7 @@ def main():
 
     print(f"\nCommands received by simulated ESP32: {len(commands_received)}")
     for i, cmd in enumerate(commands_received, 1):
-        print(f"  {i}. {json.dumps(cmd)}")
+        print(f"  {i}. {orjson.dumps(cmd).decode()}")
 
     # Verify database updates
     print(f"\n📊 Verifying database...")
@@ -3,16 +3,23 @@
 Test 8: Device Command Queue & Control (Simplified for Render execution)
 Run via: timeout 30 python3 test_command_queue_simple.py
 """
-import json
+import logging
+import orjson
+import threading
 import time
+import uuid
 import os
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
-import ssl
-from supabase import create_client
+import mqtt_session
+from supabase_session import get_supabase, get_device_id
 
 load_dotenv()
 
+# LOG_LEVEL=DEBUG also prints each received command as one line of JSON
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+log = logging.getLogger(__name__)
+
 MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
@@ -23,45 +30,55 @@ SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE")
 
 TEST_MAC = "CMDTEST01"
 commands_received = []
+cmd_event = threading.Event()
+subscribed = threading.Event()
 
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         print(f"✓ Connected! Subscribing to ESP32CAM/{TEST_MAC}/cmd")
         client.subscribe(f"ESP32CAM/{TEST_MAC}/cmd")
-        time.sleep(1)
     else:
         print(f"✗ Connection failed: {rc}")
 
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    subscribed.set()
+
+def wait_for_commands(count: int, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while len(commands_received) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not cmd_event.wait(remaining):
+            return False
+        cmd_event.clear()
+    return True
+
 def on_message(client, userdata, msg):
     global commands_received
-    print(f"\n📩 Command received: {msg.topic}")
+    log.info("\n📩 Command received: %s", msg.topic)
     try:
-        payload = json.loads(msg.payload.decode())
-        print(f"   {json.dumps(payload)}")
+        payload = orjson.loads(msg.payload)
         commands_received.append(payload)
+        cmd_event.set()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("   %s", orjson.dumps(payload).decode())
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
 
-def insert_command(sb, device_id: str, command_type: str, command_payload: dict = None):
-    cmd_data = {
+def command_row(device_id: str, command_type: str, command_payload: dict = None):
+    return {
+        "command_id": str(uuid.uuid4()),  # client-side, so inserts need no response body
         "device_id": device_id,
         "command_type": command_type,
         "command_payload": command_payload or {},
         "status": "queued"
     }
-    result = sb.table("device_commands").insert(cmd_data).execute()
-    return result.data[0] if result.data else None
 
-def ensure_test_device(sb, device_hw_id: str):
-    result = sb.table("devices").select("device_id").eq("device_hw_id", device_hw_id).execute()
-    if result.data:
-        return result.data[0]["device_id"]
+def insert_command(sb, device_id: str, command_type: str, command_payload: dict = None):
+    return insert_commands(sb, [command_row(device_id, command_type, command_payload)])[0]
 
-    ins = sb.table("devices").insert({
-        "device_hw_id": device_hw_id,
-        "model": "ESP32S3-CAM"
-    }).execute()
-    return ins.data[0]["device_id"]
+def insert_commands(sb, rows: list):
+    sb.table("device_commands").insert(rows, returning="minimal").execute()
+    return rows
 
 def main():
     print("="*60)
@@ -73,38 +90,45 @@ def main():
         print("❌ Missing Supabase credentials in environment")
         return
 
-    sb = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE)
-    device_id = ensure_test_device(sb, TEST_MAC)
+    sb = get_supabase()
+    device_id = get_device_id(TEST_MAC)
     print(f"✓ Device ID: {device_id}")
 
     # Connect MQTT
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="test-esp32-cmd")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
+    # Shared context: verifies the broker like the worker, resumes TLS sessions
+    client.tls_set_context(mqtt_session.TLS_CONTEXT)
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     client.on_connect = on_connect
+    client.on_socket_open = mqtt_session.on_socket_open
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
 
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
     client.loop_start()
-    time.sleep(2)
+    if not subscribed.wait(timeout=10):
+        print("❌ No SUBACK from broker within 10s")
+        client.loop_stop()
+        return
 
     # Insert test commands
     print("\n1️⃣  Inserting capture_image command...")
     cmd1 = insert_command(sb, device_id, "capture_image")
     print(f"   Command ID: {cmd1['command_id']}")
-    time.sleep(3)
+    wait_for_commands(1)
 
     print("\n2️⃣  Inserting send_image command...")
     cmd2 = insert_command(sb, device_id, "send_image", {"image_name": "test_001.jpg"})
     print(f"   Command ID: {cmd2['command_id']}")
-    time.sleep(3)
+    wait_for_commands(2)
 
     print("\n3️⃣  Inserting 3 commands rapidly...")
-    insert_command(sb, device_id, "capture_image")
-    insert_command(sb, device_id, "send_image", {"image_name": "test_002.jpg"})
-    insert_command(sb, device_id, "send_image", {"image_name": "test_003.jpg"})
-    time.sleep(5)
+    insert_commands(sb, [
+        command_row(device_id, "capture_image"),
+        command_row(device_id, "send_image", {"image_name": "test_002.jpg"}),
+        command_row(device_id, "send_image", {"image_name": "test_003.jpg"}),
+    ])
+    wait_for_commands(5, timeout=10)
 
     client.loop_stop()
     client.disconnect()
@@ -113,7 +137,7 @@ def main():
     print("\n" + "="*60)
     print(f"Commands received: {len(commands_received)}")
     for i, cmd in enumerate(commands_received, 1):
-        print(f"  {i}. {json.dumps(cmd)}")
+        print(f"  {i}. {orjson.dumps(cmd).decode()}")
 
     success = len(commands_received) >= 5
     if success:
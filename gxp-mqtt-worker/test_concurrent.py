@@ -14,24 +14,36 @@ Expected behavior:
 4. SHA256 hashes verify correct per-device assembly
 5. No race conditions or memory corruption
 """
-import json
-import base64
+import asyncio
+import logging
+import orjson
+import binascii
 import time
 import os
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import ssl
 import hashlib
+import mqtt_session
 import threading
 from datetime import datetime
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+log = logging.getLogger(__name__)
+
 MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
+# "binary": raw bytes on ESP32CAM/{MAC}/chunk/{chunk_id} (MQTT v5)
+# "json": legacy base64 JSON chunks on ESP32CAM/{MAC}/data
+CHUNK_FORMAT = os.getenv("CHUNK_FORMAT", "binary")
+
 # Define 3 concurrent devices with unique data
 DEVICES = [
     {
@@ -62,7 +74,39 @@ DEVICES = [
 
 RESET = "\033[0m"
 
-# Calculate expected hashes
+def build_chunk_messages(device):
+    """Encode every chunk message for a device up front as (topic, payload) pairs"""
+    data = memoryview(device["data"])
+    csz = device["chunk_size"]
+    chunks = [data[i * csz:(i + 1) * csz] for i in range(device["total_chunks"])]
+
+    if CHUNK_FORMAT == "binary":
+        # Invariants ride in the topic and the metadata message, so the
+        # payload is just the chunk bytes
+        topic = f"ESP32CAM/{device['device_id']}/chunk/"
+        return [(f"{topic}{chunk_id}", bytes(chunk)) for chunk_id, chunk in enumerate(chunks)]
+
+    # Only chunk_id and payload vary, so the JSON is spliced from a
+    # prebuilt template instead of building and dumping a dict per chunk
+    prefix = (f'{{"device_id":"{device["device_id"]}","image_name":"{device["image_name"]}",'
+              f'"max_chunk_size":{csz},"chunk_id":').encode()
+    mid = b',"payload":"'
+    suffix = b'"}'
+    return [(device["topic_data"],
+             b"".join((prefix, str(chunk_id).encode(), mid,
+                       binascii.b2a_base64(chunk, newline=False), suffix)))
+            for chunk_id, chunk in enumerate(chunks)]
+
+def chunk_properties(device):
+    """MQTT v5 user properties naming the image for binary chunks"""
+    if CHUNK_FORMAT != "binary":
+        return None
+    props = Properties(PacketTypes.PUBLISH)
+    props.UserProperty = [("img", device["image_name"])]
+    return props
+
+# Precompute hashes, topics and every message body once at import, so
+# send_device_data only publishes ready-made bytes
 for device in DEVICES:
     device["expected_hash"] = hashlib.sha256(device["data"]).hexdigest()
     device["total_chunks"] = len(device["data"]) // device["chunk_size"]
@@ -70,124 +114,130 @@ for device in DEVICES:
     device["start_time"] = None
     device["end_time"] = None
 
+    device["topic_status"] = f"ESP32CAM/{device['device_id']}/status"
+    device["topic_data"] = f"ESP32CAM/{device['device_id']}/data"
+    device["status_json"] = orjson.dumps({
+        "device_id": device["device_id"],
+        "status": "Alive",
+        "pendingImg": 1
+    })
+    device["metadata_json"] = orjson.dumps({
+        "device_id": device["device_id"],
+        "capture_timeStamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "image_name": device["image_name"],
+        "image_size": len(device["data"]),
+        "max_chunks_size": device["chunk_size"],
+        "total_chunk_count": device["total_chunks"],
+        "location": "concurrent_test",
+        "error": 0,
+        "temperature": 24.0,
+        "humidity": 55.0,
+        "pressure": 1013.0,
+        "gas_resistance": 50000.0
+    })
+    device["chunk_messages"] = build_chunk_messages(device)
+    device["chunk_properties"] = chunk_properties(device)
+
+DEVICES_BY_ID = {device["device_id"]: device for device in DEVICES}
+
+# One digest over every image, length-prefixed so boundaries count, hashed
+# in a single C call; identifies the exact fixture a run used
+FIXTURE_DIGEST = hashlib.sha256(b"".join(
+    len(device["data"]).to_bytes(4, "big") + device["data"] for device in DEVICES
+)).hexdigest()
+
 results_lock = threading.Lock()
 
+# Set on SUBACK for the ACK wildcard, so sending starts as soon as ACKs can arrive
+subscribed = threading.Event()
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    subscribed.set()
+
 def on_message(client, userdata, msg):
     """Handle ACK messages from worker"""
-    # Find which device this ACK is for
-    for device in DEVICES:
-        if device["device_id"] in msg.topic:
-            try:
-                payload = json.loads(msg.payload.decode())
-
-                if "ACK_OK" in payload:
-                    with results_lock:
-                        device["ack_received"] = True
-                        device["end_time"] = time.time()
-                        elapsed = device["end_time"] - device["start_time"]
-
-                    print(f"{device['color']}✅ [{device['device_id']}] ACK_OK received ({elapsed:.2f}s){RESET}")
-
-                elif "missing_chunks" in payload:
-                    missing = payload.get("missing_chunks", [])
-                    print(f"{device['color']}⚠️  [{device['device_id']}] NACK: {len(missing)} missing chunks{RESET}")
-
-            except Exception as e:
-                print(f"Error parsing ACK for {device['device_id']}: {e}")
-            break
-
-def send_device_data(device):
-    """Send complete image sequence for one device"""
-    client = mqtt.Client(
-        mqtt.CallbackAPIVersion.VERSION2,
-        client_id=f"test-{device['device_id']}"
-    )
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.on_message = on_message
+    # Find which device this ACK is for: ESP32CAM/{device_id}/ack
+    device = DEVICES_BY_ID.get(msg.topic.split("/")[1])
+    if device is None:
+        return
 
     try:
-        client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-        client.loop_start()
+        payload = orjson.loads(msg.payload)
+
+        if "ACK_OK" in payload:
+            with results_lock:
+                device["ack_received"] = True
+                device["end_time"] = time.time()
+                elapsed = device["end_time"] - device["start_time"]
+            # Wake the device's coroutine; userdata is the asyncio loop
+            userdata.call_soon_threadsafe(device["ack_event"].set)
 
-        # Subscribe to this device's ACK topic
-        ack_topic = f"ESP32CAM/{device['device_id']}/ack"
-        client.subscribe(ack_topic)
+            log.info("%s✅ [%s] ACK_OK received (%.2fs)%s",
+                     device["color"], device["device_id"], elapsed, RESET)
 
-        time.sleep(0.5)  # Brief connection stabilization
+        elif "missing_chunks" in payload:
+            missing = payload.get("missing_chunks", [])
+            log.warning("%s⚠️  [%s] NACK: %d missing chunks%s",
+                        device["color"], device["device_id"], len(missing), RESET)
 
+    except Exception as e:
+        log.error("Error parsing ACK for %s: %s", device["device_id"], e)
+
+async def send_device_data(client, device, delay):
+    """Send complete image sequence for one device over the shared client"""
+    await asyncio.sleep(delay)  # Slight stagger to simulate real-world timing
+    try:
         device["start_time"] = time.time()
 
         # 1. Send status
         print(f"{device['color']}📤 [{device['device_id']}] Sending status{RESET}")
-        status = {
-            "device_id": device["device_id"],
-            "status": "Alive",
-            "pendingImg": 1
-        }
-        client.publish(f"ESP32CAM/{device['device_id']}/status", json.dumps(status), qos=1)
-        time.sleep(0.2)
+        client.publish(device["topic_status"], device["status_json"], qos=1)
+        await asyncio.sleep(0.2)
 
         # 2. Send metadata
         print(f"{device['color']}📤 [{device['device_id']}] Sending metadata ({device['total_chunks']} chunks){RESET}")
-        metadata = {
-            "device_id": device["device_id"],
-            "capture_timeStamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "image_name": device["image_name"],
-            "image_size": len(device["data"]),
-            "max_chunks_size": device["chunk_size"],
-            "total_chunk_count": device["total_chunks"],
-            "location": "concurrent_test",
-            "error": 0,
-            "temperature": 24.0,
-            "humidity": 55.0,
-            "pressure": 1013.0,
-            "gas_resistance": 50000.0
-        }
-        client.publish(f"ESP32CAM/{device['device_id']}/data", json.dumps(metadata), qos=1)
-        time.sleep(0.2)
-
-        # 3. Send chunks
+        client.publish(device["topic_data"], device["metadata_json"], qos=1)
+        await asyncio.sleep(0.2)
+
+        # 3. Send chunks - QoS 0 back-to-back, the worker NACKs anything lost.
+        # The last chunk goes QoS 1 so wait_for_publish() is one sync point.
         print(f"{device['color']}📤 [{device['device_id']}] Sending {device['total_chunks']} chunks{RESET}")
-        for chunk_id in range(device["total_chunks"]):
-            start = chunk_id * device["chunk_size"]
-            end = min(start + device["chunk_size"], len(device["data"]))
-            chunk_bytes = device["data"][start:end]
-            chunk_b64 = base64.b64encode(chunk_bytes).decode()
-
-            chunk = {
-                "device_id": device["device_id"],
-                "image_name": device["image_name"],
-                "chunk_id": chunk_id,
-                "max_chunk_size": device["chunk_size"],
-                "payload": chunk_b64
-            }
-
-            client.publish(f"ESP32CAM/{device['device_id']}/data", json.dumps(chunk), qos=1)
-            time.sleep(0.1)  # Small delay between chunks
+        messages = device["chunk_messages"]
+        props = device["chunk_properties"]
+        for topic, payload in messages[:-1]:
+            client.publish(topic, payload, qos=0, properties=props)
+        topic, payload = messages[-1]
+        msg_info = client.publish(topic, payload, qos=1, properties=props)
+        await asyncio.to_thread(msg_info.wait_for_publish, 5)
 
         print(f"{device['color']}✓ [{device['device_id']}] All chunks sent{RESET}")
 
         # Wait for ACK
-        timeout = 15
-        elapsed = 0
-        while elapsed < timeout and not device["ack_received"]:
-            time.sleep(0.5)
-            elapsed += 0.5
-
-        client.loop_stop()
-        client.disconnect()
+        try:
+            await asyncio.wait_for(device["ack_event"].wait(), timeout=15)
+        except asyncio.TimeoutError:
+            pass
 
     except Exception as e:
         print(f"{device['color']}✗ [{device['device_id']}] Error: {e}{RESET}")
 
+async def run_devices(client):
+    """Fan out all devices concurrently and wait for every sequence to finish"""
+    client.user_data_set(asyncio.get_running_loop())
+    for device in DEVICES:
+        device["ack_event"] = asyncio.Event()
+
+    await asyncio.gather(*(send_device_data(client, device, 0.2 * i)
+                           for i, device in enumerate(DEVICES)))
+
 def main():
     print("="*80)
     print("Concurrent Device Load Test")
     print("="*80)
     print(f"\nTesting {len(DEVICES)} devices transmitting simultaneously...")
-    print(f"Each device has unique data pattern for cross-contamination detection\n")
+    print(f"Each device has unique data pattern for cross-contamination detection")
+    print(f"SHA256 backend: {ssl.OPENSSL_VERSION}")
+    print(f"Fixture digest: {FIXTURE_DIGEST[:16]}...\n")
 
     for device in DEVICES:
         print(f"{device['color']}Device: {device['device_id']}{RESET}")
@@ -196,22 +246,38 @@ def main():
         print(f"  Expected SHA256: {device['expected_hash'][:16]}...")
         print(f"  Data pattern: {device['data'].hex()}\n")
 
+    # One connection for all simulated devices; the broker routes by
+    # topic, so each device only needs its own topics, not its own TLS session
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="test-concurrent",
+                         protocol=mqtt.MQTTv5)  # user properties on binary chunks
+    # Let QoS 1 publishes from every device stream without waiting on
+    # PUBACKs once the default window of 20 fills
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(0)  # unbounded
+    # Shared context: verifies the broker like the worker, resumes TLS sessions
+    client.tls_set_context(mqtt_session.TLS_CONTEXT)
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.on_socket_open = mqtt_session.on_socket_open
+    client.on_subscribe = on_subscribe
+    client.on_message = on_message
+
+    client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
+    client.loop_start()
+    client.subscribe("ESP32CAM/+/ack")
+    if not subscribed.wait(timeout=10):
+        print("✗ No SUBACK from broker within 10s")
+        client.loop_stop()
+        return
+
     print("="*80)
     print("Starting concurrent transmission...\n")
 
-    # Launch all devices in parallel threads
-    threads = []
+    # Run all devices as coroutines on one thread instead of one thread each
     start_time = time.time()
+    asyncio.run(run_devices(client))
 
-    for device in DEVICES:
-        thread = threading.Thread(target=send_device_data, args=(device,))
-        thread.start()
-        threads.append(thread)
-        time.sleep(0.2)  # Slight stagger to simulate real-world timing
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    client.loop_stop()
+    client.disconnect()
 
     total_time = time.time() - start_time
 
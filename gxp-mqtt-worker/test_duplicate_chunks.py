@@ -15,22 +15,22 @@ Expected behavior:
 - Duplicate chunks are silently ignored (not an error)
 - Final image is correct (SHA256 verification)
 - ACK_OK sent after all unique chunks received
+- A duplicate of the last chunk does not reopen the finished capture
 """
-import json
+import orjson
 import base64
-import time
 import os
-from dotenv import load_dotenv
-import paho.mqtt.client as mqtt
-import ssl
+import time
+import threading
 import hashlib
+import mqtt_session
+from supabase_session import get_supabase, get_device_id
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
-load_dotenv()
-
-MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
-MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
-MQTT_USERNAME = os.getenv("MQTT_USERNAME")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+# "binary": raw bytes on ESP32CAM/{MAC}/chunk/{chunk_id} (MQTT v5)
+# "json": legacy base64 JSON chunks on ESP32CAM/{MAC}/data
+CHUNK_FORMAT = os.getenv("CHUNK_FORMAT", "binary")
 
 TEST_MAC = "DUPLICATE01"
 TEST_IMAGE = "duplicate_test.jpg"
@@ -42,28 +42,59 @@ TOTAL_CHUNKS = 5
 
 EXPECTED_SHA256 = hashlib.sha256(JPEG_BYTES).hexdigest()
 
-ack_received = False
+# Status and metadata never change between runs; encode them once
+STATUS_JSON = orjson.dumps({"device_id": TEST_MAC, "status": "Alive", "pendingImg": 1})
+METADATA_JSON = orjson.dumps({
+    "device_id": TEST_MAC,
+    "capture_timeStamp": "2025-10-04T22:00:00Z",
+    "image_name": TEST_IMAGE,
+    "image_size": len(JPEG_BYTES),
+    "max_chunks_size": CHUNK_SIZE,
+    "total_chunk_count": TOTAL_CHUNKS,
+    "location": "duplicate_test",
+    "error": 0,
+    "temperature": 23.0,
+    "humidity": 53.0,
+    "pressure": 1012.0,
+    "gas_resistance": 49000.0
+})
+
+# Slice and encode each chunk once as (topic, payload); duplicates resend
+# the same message
+CHUNKS = [JPEG_BYTES[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE] for i in range(TOTAL_CHUNKS)]
+if CHUNK_FORMAT == "binary":
+    # Everything but the chunk_id is already in the metadata message, and
+    # the chunk_id rides in the topic: no JSON envelope, no base64
+    CHUNK_MESSAGES = [(f"ESP32CAM/{TEST_MAC}/chunk/{chunk_id}", chunk_bytes)
+                      for chunk_id, chunk_bytes in enumerate(CHUNKS)]
+    CHUNK_PROPERTIES = Properties(PacketTypes.PUBLISH)
+    CHUNK_PROPERTIES.UserProperty = [("img", TEST_IMAGE)]
+else:
+    CHUNK_MESSAGES = [
+        (f"ESP32CAM/{TEST_MAC}/data", orjson.dumps({
+            "device_id": TEST_MAC,
+            "image_name": TEST_IMAGE,
+            "chunk_id": chunk_id,
+            "max_chunk_size": CHUNK_SIZE,
+            "payload": base64.b64encode(chunk_bytes).decode()
+        }))
+        for chunk_id, chunk_bytes in enumerate(CHUNKS)
+    ]
+    CHUNK_PROPERTIES = None
+
+ack_event = threading.Event()
 nack_count = 0
 
-def on_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        print(f"✓ Connected!")
-        client.subscribe(f"ESP32CAM/{TEST_MAC}/ack")
-        print(f"✓ Subscribed to ESP32CAM/{TEST_MAC}/ack")
-        time.sleep(1)
-    else:
-        print(f"✗ Connection failed: {rc}")
-
 def on_message(client, userdata, msg):
-    global ack_received, nack_count
+    global nack_count
 
     print(f"\n📩 Received on {msg.topic}:")
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
+        print(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
 
         if "ACK_OK" in payload:
-            ack_received = True
+            ack_event.set()
             print(f"\n✅ ACK_OK received! Assembly complete.")
         elif "missing_chunks" in payload:
             nack_count += 1
@@ -73,21 +104,12 @@ def on_message(client, userdata, msg):
     except Exception as e:
         print(f"Error: {e}")
 
-def send_chunk(client, chunk_id, chunk_bytes):
-    """Send a single chunk"""
-    chunk_b64 = base64.b64encode(chunk_bytes).decode()
-    chunk = {
-        "device_id": TEST_MAC,
-        "image_name": TEST_IMAGE,
-        "chunk_id": chunk_id,
-        "max_chunk_size": CHUNK_SIZE,
-        "payload": chunk_b64
-    }
-    client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(chunk), qos=1)
+def send_chunk(client, chunk_id):
+    """Send a single chunk; returns the MQTTMessageInfo for its PUBACK"""
+    topic, payload = CHUNK_MESSAGES[chunk_id]
+    return client.publish(topic, payload, qos=1, properties=CHUNK_PROPERTIES)
 
 def main():
-    global ack_received, nack_count
-
     print("="*70)
     print("Duplicate Chunk Handling Test")
     print("="*70)
@@ -101,106 +123,87 @@ def main():
     print("  - Chunk 3: sent once")
     print("  - Chunk 4: sent TWICE (duplicate)")
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="duplicate-test")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    print(f"\nConnecting to {MQTT_HOST}:{MQTT_PORT}...")
-    client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-    client.loop_start()
-
-    time.sleep(2)
+    client = mqtt_session.get_client()
+    ack_topic = f"ESP32CAM/{TEST_MAC}/ack"
+    mqtt_session.add_handler(ack_topic, on_message)
 
     # 1. Status
     print(f"\n📤 Step 1: Sending status...")
-    status = {"device_id": TEST_MAC, "status": "Alive", "pendingImg": 1}
-    client.publish(f"ESP32CAM/{TEST_MAC}/status", json.dumps(status), qos=1)
+    client.publish(f"ESP32CAM/{TEST_MAC}/status", STATUS_JSON, qos=1)
     time.sleep(0.5)
 
     # 2. Metadata
     print(f"\n📤 Step 2: Sending metadata ({TOTAL_CHUNKS} unique chunks)...")
-    metadata = {
-        "device_id": TEST_MAC,
-        "capture_timeStamp": "2025-10-04T22:00:00Z",
-        "image_name": TEST_IMAGE,
-        "image_size": len(JPEG_BYTES),
-        "max_chunks_size": CHUNK_SIZE,
-        "total_chunk_count": TOTAL_CHUNKS,
-        "location": "duplicate_test",
-        "error": 0,
-        "temperature": 23.0,
-        "humidity": 53.0,
-        "pressure": 1012.0,
-        "gas_resistance": 49000.0
-    }
-    client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(metadata), qos=1)
+    client.publish(f"ESP32CAM/{TEST_MAC}/data", METADATA_JSON, qos=1)
     time.sleep(0.5)
 
     # 3. Send chunks with duplicates
-    print(f"\n📤 Step 3: Sending chunks with duplicates...")
+    print(f"\n📤 Step 3: Sending {CHUNK_FORMAT} chunks with duplicates...")
+    infos = []
 
     # Chunk 0 (sent once)
     chunk_id = 0
-    chunk_bytes = JPEG_BYTES[chunk_id*CHUNK_SIZE:(chunk_id+1)*CHUNK_SIZE]
+    chunk_bytes = CHUNKS[chunk_id]
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (sent 1x)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
 
     # Chunk 1 (sent TWICE - duplicate)
     chunk_id = 1
-    chunk_bytes = JPEG_BYTES[chunk_id*CHUNK_SIZE:(chunk_id+1)*CHUNK_SIZE]
+    chunk_bytes = CHUNKS[chunk_id]
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (sent 1x)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (DUPLICATE)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
 
     # Chunk 2 (sent THREE times - 2 duplicates)
     chunk_id = 2
-    chunk_bytes = JPEG_BYTES[chunk_id*CHUNK_SIZE:(chunk_id+1)*CHUNK_SIZE]
+    chunk_bytes = CHUNKS[chunk_id]
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (sent 1x)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (DUPLICATE #1)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (DUPLICATE #2)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
 
     # Chunk 3 (sent once)
     chunk_id = 3
-    chunk_bytes = JPEG_BYTES[chunk_id*CHUNK_SIZE:(chunk_id+1)*CHUNK_SIZE]
+    chunk_bytes = CHUNKS[chunk_id]
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (sent 1x)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
 
     # Chunk 4 (sent TWICE - duplicate)
     chunk_id = 4
-    chunk_bytes = JPEG_BYTES[chunk_id*CHUNK_SIZE:(chunk_id+1)*CHUNK_SIZE]
+    chunk_bytes = CHUNKS[chunk_id]
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (sent 1x)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
     print(f"   Chunk {chunk_id}: {chunk_bytes.hex()} (DUPLICATE)")
-    send_chunk(client, chunk_id, chunk_bytes)
-    time.sleep(0.3)
+    infos.append(send_chunk(client, chunk_id))
+
+    # QoS 1 already orders and acknowledges each chunk; wait for the PUBACKs
+    # once at the end instead of sleeping between publishes
+    for info in infos:
+        info.wait_for_publish(timeout=5)
 
     print(f"\n✓ All chunks sent (5 unique + 4 duplicates = 9 total messages)")
     print(f"⏳ Waiting for assembly and ACK...")
 
     # Wait for ACK
-    timeout = 15
-    elapsed = 0
-    while elapsed < timeout and not ack_received:
-        time.sleep(0.5)
-        elapsed += 0.5
+    ack_received = ack_event.wait(timeout=15)
+    mqtt_session.remove_handler(ack_topic, on_message)
 
-    client.loop_stop()
-    client.disconnect()
+    # The trailing duplicate of chunk 4 lands right after finalization; give
+    # the worker a moment to (wrongly) reopen the capture before reading it
+    time.sleep(2)
+    rows = get_supabase().table("captures") \
+        .select("ingest_status, image_sha256") \
+        .eq("device_id", get_device_id(TEST_MAC)) \
+        .eq("device_capture_id", TEST_IMAGE) \
+        .order("created_at", desc=True) \
+        .limit(1) \
+        .execute().data
+    final_status = rows[0]["ingest_status"] if rows else None
+    stored_sha256 = rows[0]["image_sha256"] if rows else None
+    row_ok = final_status == "success" and stored_sha256 == EXPECTED_SHA256
 
     # Results
     print("\n" + "="*70)
@@ -209,21 +212,19 @@ def main():
 
     print(f"ACK_OK received: {'✅ YES' if ack_received else '❌ NO'}")
     print(f"NACK count: {nack_count}")
+    print(f"Final ingest_status: {final_status}")
+    print(f"Stored SHA256 matches: {'✅ YES' if stored_sha256 == EXPECTED_SHA256 else '❌ NO'}")
 
-    if ack_received:
+    if ack_received and row_ok:
         print("\n✅ TEST PASSED: Worker handled duplicate chunks correctly!")
-        print("\nVerification Steps:")
-        print("1. Check Supabase Storage for image:")
-        print(f"   Path: captures/{TEST_MAC}/2025/10/04/{TEST_IMAGE}")
-        print(f"2. Verify image SHA256 hash: {EXPECTED_SHA256}")
-        print("\nSQL Verification:")
-        print(f"SELECT image_sha256, image_bytes, ingest_status FROM captures")
-        print(f"WHERE device_hw_id='{TEST_MAC}' ORDER BY created_at DESC LIMIT 1;")
-        print(f"\nExpected SHA256: {EXPECTED_SHA256}")
-        print("If SHA256 matches, duplicates were correctly ignored (idempotent).")
-    else:
+        print("\nThe image is in Supabase Storage at:")
+        print(f"   captures/{TEST_MAC}/2025/10/04/{TEST_IMAGE}")
+    elif not ack_received:
         print("\n❌ TEST FAILED: No ACK received")
         print("Worker may not be correctly handling duplicate chunks.")
+    else:
+        print("\n❌ TEST FAILED: Capture row was not left as a successful ingest")
+        print("A late duplicate chunk may have reopened the finished capture.")
 
     print("="*70)
 
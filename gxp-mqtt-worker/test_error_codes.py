@@ -17,19 +17,13 @@ Expected behavior:
 4. No image upload attempted (no Storage write for failed captures)
 5. Worker sends ACK_ERROR or similar acknowledgment to device
 """
-import json
+import orjson
 import time
-import os
-from dotenv import load_dotenv
-import paho.mqtt.client as mqtt
-import ssl
-
-load_dotenv()
-
-MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
-MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
-MQTT_USERNAME = os.getenv("MQTT_USERNAME")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import mqtt_session
+from supabase_session import get_device_id, count_device_errors, wait_for_device_error
 
 # Test cases for different ESP32 error codes
 ERROR_TEST_CASES = [
@@ -75,30 +69,49 @@ ERROR_TEST_CASES = [
     }
 ]
 
+def build_metadata(test_case):
+    """Encode a test case's metadata frame: error code set, no image"""
+    return orjson.dumps({
+        "device_id": test_case['device_id'],
+        "capture_timeStamp": "2025-10-05T17:30:00Z",
+        "image_name": test_case['image_name'],
+        "image_size": 0,  # No image when error occurs
+        "max_chunks_size": 1024,
+        "total_chunk_count": 0,  # No chunks will be sent
+        "location": "error_test_lab",
+        "error": test_case['error_code'],  # ← ESP32 error code
+        "temperature": 23.5,  # Sensor data may still be valid
+        "humidity": 55.0,
+        "pressure": 1012.0,
+        "gas_resistance": 52000.0
+    })
+
+# Encode every case's frames once up front, outside the send path
+for test in ERROR_TEST_CASES:
+    test['status_json'] = orjson.dumps({"device_id": test['device_id'], "status": "Alive", "pendingImg": 1})
+    test['metadata_json'] = build_metadata(test)
+
+# Seconds each case waits for its device's ACK. The worker may handle ESP32
+# errors silently, so cases run concurrently and share this window.
+ACK_TIMEOUT_S = 5
+# Seconds to wait for the worker's batched device_errors insert to land
+DB_TIMEOUT_S = 10
+
 test_results = []
 ack_received = {}
-
-def on_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        print(f"✓ Connected!")
-        # Subscribe to all ACK topics
-        for test in ERROR_TEST_CASES:
-            client.subscribe(f"ESP32CAM/{test['device_id']}/ack")
-        time.sleep(1)
-    else:
-        print(f"✗ Connection failed: {rc}")
+ack_events = {test['device_id']: threading.Event() for test in ERROR_TEST_CASES}
+ACK_TOPICS = [f"ESP32CAM/{test['device_id']}/ack" for test in ERROR_TEST_CASES]
 
 def on_message(client, userdata, msg):
+    device_id = msg.topic.split("/")[1]
     print(f"\n📩 Received on {msg.topic}:")
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
+        print(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
 
         # Track ACK responses
-        for test in ERROR_TEST_CASES:
-            if test['device_id'] in msg.topic:
-                ack_received[test['device_id']] = payload
-                break
+        ack_received[device_id] = payload
+        ack_events[device_id].set()
 
     except Exception as e:
         print(f"Error parsing message: {e}")
@@ -115,35 +128,46 @@ def send_error_test(client, test_case):
 
     # 1. Status
     print(f"\n📤 Step 1: Sending status...")
-    status = {"device_id": device_id, "status": "Alive", "pendingImg": 1}
-    client.publish(f"ESP32CAM/{device_id}/status", json.dumps(status), qos=1)
+    client.publish(f"ESP32CAM/{device_id}/status", test_case['status_json'], qos=1)
     time.sleep(0.5)
 
     # 2. Metadata with error code (and valid sensor data)
     print(f"\n📤 Step 2: Sending metadata with ERROR CODE {test_case['error_code']}...")
-    metadata = {
-        "device_id": device_id,
-        "capture_timeStamp": "2025-10-05T17:30:00Z",
-        "image_name": test_case['image_name'],
-        "image_size": 0,  # No image when error occurs
-        "max_chunks_size": 1024,
-        "total_chunk_count": 0,  # No chunks will be sent
-        "location": "error_test_lab",
-        "error": test_case['error_code'],  # ← ESP32 error code
-        "temperature": 23.5,  # Sensor data may still be valid
-        "humidity": 55.0,
-        "pressure": 1012.0,
-        "gas_resistance": 52000.0
-    }
-    client.publish(f"ESP32CAM/{device_id}/data", json.dumps(metadata), qos=1)
-    print(json.dumps(metadata, indent=2))
-    time.sleep(1.5)
+    client.publish(f"ESP32CAM/{device_id}/data", test_case['metadata_json'], qos=1)
+    print(test_case['metadata_json'].decode())
 
     # 3. NO chunks sent (error case - no image captured)
     print(f"📤 Step 3: No chunks sent (error={test_case['error_code']} - no image)")
 
     print(f"\n⏳ Waiting for worker to process error...")
-    time.sleep(2)
+    ack_events[device_id].wait(timeout=ACK_TIMEOUT_S)
+
+@pytest.mark.parametrize("test_case", ERROR_TEST_CASES, ids=lambda t: t['device_id'])
+def test_esp32_error_code(mqtt_client, supabase_client, test_case):
+    """An ESP32-reported error is logged as 1000+code and fails the capture,
+    and is not acknowledged as a stored capture"""
+    device_id = test_case['device_id']
+    error_code = 1000 + test_case['error_code']
+    baseline = count_device_errors(supabase_client, device_id, error_code)
+
+    topic = f"ESP32CAM/{device_id}/ack"
+    mqtt_session.add_handler(topic, on_message)
+    try:
+        send_error_test(mqtt_client, test_case)
+    finally:
+        mqtt_session.remove_handler(topic, on_message)
+    assert "ACK_OK" not in ack_received.get(device_id, {})
+
+    # Positive checks: these fail if no worker handled the metadata
+    assert wait_for_device_error(supabase_client, device_id, error_code,
+                                 baseline, DB_TIMEOUT_S)
+    rows = supabase_client.table("captures") \
+        .select("ingest_status, ingest_error") \
+        .eq("device_id", get_device_id(device_id)) \
+        .eq("device_capture_id", test_case['image_name']) \
+        .execute().data
+    assert rows and rows[0]["ingest_status"] == "failed"
+    assert rows[0]["ingest_error"].startswith(f"ESP32 error {test_case['error_code']}:")
 
 def main():
     print("="*70)
@@ -157,29 +181,17 @@ def main():
     print(f"  4. No Storage upload attempted (no image to upload)")
     print(f"  5. Worker sends appropriate ACK response")
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="error-code-test")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    print(f"\nConnecting to {MQTT_HOST}:{MQTT_PORT}...")
-    client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-    client.loop_start()
-
-    time.sleep(2)
-
-    # Run all error code tests
-    for test_case in ERROR_TEST_CASES:
-        send_error_test(client, test_case)
-        time.sleep(3)  # Gap between tests
+    client = mqtt_session.get_client()
+    for topic in ACK_TOPICS:
+        mqtt_session.add_handler(topic, on_message)
 
-    print(f"\n⏳ Waiting for final worker processing...")
-    time.sleep(3)
+    # Run all error code tests concurrently: each targets its own device_id,
+    # and paho's publish() is safe to call from several threads
+    with ThreadPoolExecutor(max_workers=len(ERROR_TEST_CASES)) as pool:
+        list(pool.map(lambda test_case: send_error_test(client, test_case), ERROR_TEST_CASES))
 
-    client.loop_stop()
-    client.disconnect()
+    for topic in ACK_TOPICS:
+        mqtt_session.remove_handler(topic, on_message)
 
     # Print results
     print("\n" + "="*70)
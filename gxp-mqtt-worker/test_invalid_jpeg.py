@@ -13,20 +13,13 @@ Expected behavior:
 - Should mark capture as "failed"
 - Should NOT upload to storage
 """
-import json
+import orjson
 import base64
 import time
-import os
-from dotenv import load_dotenv
-import paho.mqtt.client as mqtt
-import ssl
-
-load_dotenv()
-
-MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
-MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
-MQTT_USERNAME = os.getenv("MQTT_USERNAME")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+import threading
+import pytest
+import mqtt_session
+from supabase_session import get_device_id, count_device_errors, wait_for_device_error
 
 TEST_CASES = [
     {
@@ -34,21 +27,24 @@ TEST_CASES = [
         "device_id": "INVALID101",
         "image_name": "missing_soi.jpg",
         "data": bytes([0xAA, 0xBB, 0xCC, 0xDD, 0xFF, 0xD9]),  # No SOI, has EOI
-        "expected_error": "Invalid JPEG: missing SOI or EOI markers"
+        "expected_error": "Invalid JPEG: missing SOI or EOI markers",
+        "expected_code": 2203  # invalid_jpeg_signature
     },
     {
         "name": "Missing EOI",
         "device_id": "INVALID102",
         "image_name": "missing_eoi.jpg",
         "data": bytes([0xFF, 0xD8, 0xAA, 0xBB, 0xCC, 0xDD]),  # Has SOI, no EOI
-        "expected_error": "Invalid JPEG: missing SOI or EOI markers"
+        "expected_error": "Invalid JPEG: missing SOI or EOI markers",
+        "expected_code": 2203  # invalid_jpeg_signature
     },
     {
         "name": "Not a JPEG",
         "device_id": "INVALID103",
         "image_name": "not_jpeg.jpg",
         "data": bytes([0x89, 0x50, 0x4E, 0x47, 0x0D, 0x0A]),  # PNG signature
-        "expected_error": "Invalid JPEG: missing SOI or EOI markers"
+        "expected_error": "Invalid JPEG: missing SOI or EOI markers",
+        "expected_code": 2203  # invalid_jpeg_signature
     },
     {
         "name": "Size Mismatch",
@@ -56,32 +52,77 @@ TEST_CASES = [
         "image_name": "size_mismatch.jpg",
         "data": bytes([0xFF, 0xD8, 0xAA, 0xBB, 0xFF, 0xD9]),  # 6 bytes
         "declared_size": 100,  # Declare 100 but send 6
-        "expected_error": "Size mismatch: declared 100, actual 6"
+        "expected_error": "Size mismatch: declared 100, actual 6",
+        "expected_code": 2202  # size_mismatch
     }
 ]
 
 CHUNK_SIZE = 2
 
-test_results = []
+def build_chunk_payloads(test_case):
+    """Slice and encode a test image into (chunk_bytes, json_payload) pairs"""
+    jpeg_bytes = test_case['data']
+    payloads = []
+    for start in range(0, len(jpeg_bytes), CHUNK_SIZE):
+        chunk_bytes = jpeg_bytes[start:start + CHUNK_SIZE]
+        chunk = {
+            "device_id": test_case['device_id'],
+            "image_name": test_case['image_name'],
+            "chunk_id": start // CHUNK_SIZE,
+            "max_chunk_size": CHUNK_SIZE,
+            "payload": base64.b64encode(chunk_bytes).decode()
+        }
+        payloads.append((chunk_bytes, orjson.dumps(chunk)))
+    return payloads
+
+def build_metadata(test_case, total_chunks):
+    """Encode a test case's metadata frame"""
+    return orjson.dumps({
+        "device_id": test_case['device_id'],
+        "capture_timeStamp": "2025-10-04T21:00:00Z",
+        "image_name": test_case['image_name'],
+        "image_size": test_case.get('declared_size', len(test_case['data'])),
+        "max_chunks_size": CHUNK_SIZE,
+        "total_chunk_count": total_chunks,
+        "location": "invalid_test",
+        "error": 0,
+        "temperature": 22.0,
+        "humidity": 50.0,
+        "pressure": 1013.0,
+        "gas_resistance": 50000.0
+    })
 
-def on_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        print(f"✓ Connected!")
-        # Subscribe to all ACK topics
-        for test in TEST_CASES:
-            client.subscribe(f"ESP32CAM/{test['device_id']}/ack")
-        time.sleep(1)
-        run_all_tests(client)
-    else:
-        print(f"✗ Connection failed: {rc}")
+# Encode every case's frames once up front, outside the send loop
+for test in TEST_CASES:
+    test['chunk_payloads'] = build_chunk_payloads(test)
+    test['status_json'] = orjson.dumps({"device_id": test['device_id'], "status": "Alive", "pendingImg": 1})
+    test['metadata_json'] = build_metadata(test, len(test['chunk_payloads']))
+
+# Seconds to give the worker to finish the last case. Invalid images get no
+# ACK, so this only ends early if every device unexpectedly answers.
+SETTLE_TIMEOUT_S = 5
+# Seconds to wait for the worker's batched device_errors insert to land
+DB_TIMEOUT_S = 10
+
+ACK_TOPICS = [f"ESP32CAM/{test['device_id']}/ack" for test in TEST_CASES]
+
+test_results = []
+responses = threading.Semaphore(0)
+unexpected_acks = set()
+ack_ok_events = {test['device_id']: threading.Event() for test in TEST_CASES}
 
 def on_message(client, userdata, msg):
     print(f"\n📩 Received on {msg.topic}:")
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
+        print(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
+        if "ACK_OK" in payload:
+            device_id = msg.topic.split("/")[1]
+            unexpected_acks.add(device_id)
+            ack_ok_events[device_id].set()
     except:
         print(msg.payload.decode())
+    responses.release()
 
 def send_invalid_image(client, test_case):
     print(f"\n{'='*60}")
@@ -89,16 +130,15 @@ def send_invalid_image(client, test_case):
     print(f"{'='*60}")
 
     device_id = test_case['device_id']
-    image_name = test_case['image_name']
     jpeg_bytes = test_case['data']
     declared_size = test_case.get('declared_size', len(jpeg_bytes))
 
-    total_chunks = (len(jpeg_bytes) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunk_payloads = test_case['chunk_payloads']
+    total_chunks = len(chunk_payloads)
 
     # 1. Status
     print(f"\n📤 Sending status for {device_id}...")
-    status = {"device_id": device_id, "status": "Alive", "pendingImg": 1}
-    client.publish(f"ESP32CAM/{device_id}/status", json.dumps(status), qos=1)
+    client.publish(f"ESP32CAM/{device_id}/status", test_case['status_json'], qos=1)
     time.sleep(0.3)
 
     # 2. Metadata
@@ -106,46 +146,20 @@ def send_invalid_image(client, test_case):
     print(f"   Declared size: {declared_size} bytes")
     print(f"   Actual size: {len(jpeg_bytes)} bytes")
     print(f"   Data: {jpeg_bytes.hex()}")
-
-    metadata = {
-        "device_id": device_id,
-        "capture_timeStamp": "2025-10-04T21:00:00Z",
-        "image_name": image_name,
-        "image_size": declared_size,
-        "max_chunks_size": CHUNK_SIZE,
-        "total_chunk_count": total_chunks,
-        "location": "invalid_test",
-        "error": 0,
-        "temperature": 22.0,
-        "humidity": 50.0,
-        "pressure": 1013.0,
-        "gas_resistance": 50000.0
-    }
-    client.publish(f"ESP32CAM/{device_id}/data", json.dumps(metadata), qos=1)
+    client.publish(f"ESP32CAM/{device_id}/data", test_case['metadata_json'], qos=1)
     time.sleep(0.3)
 
     # 3. Send chunks
     print(f"📤 Sending {total_chunks} chunks...")
-    for chunk_id in range(total_chunks):
-        start = chunk_id * CHUNK_SIZE
-        end = min(start + CHUNK_SIZE, len(jpeg_bytes))
-        chunk_bytes = jpeg_bytes[start:end]
-        chunk_b64 = base64.b64encode(chunk_bytes).decode()
-
-        chunk = {
-            "device_id": device_id,
-            "image_name": image_name,
-            "chunk_id": chunk_id,
-            "max_chunk_size": CHUNK_SIZE,
-            "payload": chunk_b64
-        }
-
+    infos = []
+    for chunk_id, (chunk_bytes, payload) in enumerate(chunk_payloads):
         print(f"   Chunk {chunk_id}: {chunk_bytes.hex()}")
-        client.publish(f"ESP32CAM/{device_id}/data", json.dumps(chunk), qos=1)
-        time.sleep(0.2)
+        infos.append(client.publish(f"ESP32CAM/{device_id}/data", payload, qos=1))
+
+    # Wait for the PUBACKs once instead of sleeping between chunks
+    for info in infos:
+        info.wait_for_publish(timeout=5)
 
-    print(f"\n⏳ Waiting for worker to detect error...")
-    time.sleep(2)
 
 def run_all_tests(client):
     print("\n" + "="*60)
@@ -154,29 +168,50 @@ def run_all_tests(client):
 
     for test in TEST_CASES:
         send_invalid_image(client, test)
-        time.sleep(3)  # Wait between tests
+
+    print(f"\n⏳ Waiting for worker to detect errors...")
+    deadline = time.monotonic() + SETTLE_TIMEOUT_S
+    for _ in TEST_CASES:
+        if not responses.acquire(timeout=max(0, deadline - time.monotonic())):
+            break
+
+@pytest.mark.parametrize("test_case", TEST_CASES, ids=lambda t: t['device_id'])
+def test_invalid_jpeg_rejected(mqtt_client, supabase_client, test_case):
+    """The worker must log and fail an image that fails validation, not ACK_OK it"""
+    device_id = test_case['device_id']
+    baseline = count_device_errors(supabase_client, device_id, test_case['expected_code'])
+    topic = f"ESP32CAM/{device_id}/ack"
+    mqtt_session.add_handler(topic, on_message)
+    try:
+        send_invalid_image(mqtt_client, test_case)
+        assert not ack_ok_events[device_id].wait(timeout=SETTLE_TIMEOUT_S)
+    finally:
+        mqtt_session.remove_handler(topic, on_message)
+
+    # Positive checks: these fail if no worker validated the image
+    assert wait_for_device_error(supabase_client, device_id, test_case['expected_code'],
+                                 baseline, DB_TIMEOUT_S)
+    rows = supabase_client.table("captures") \
+        .select("ingest_status, ingest_error") \
+        .eq("device_id", get_device_id(device_id)) \
+        .eq("device_capture_id", test_case['image_name']) \
+        .execute().data
+    assert rows and rows[0]["ingest_status"] == "failed"
+    assert rows[0]["ingest_error"] == test_case['expected_error']
 
 def main():
     print("="*60)
     print("Invalid JPEG Detection Test")
     print("="*60)
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="invalid-jpeg-test")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    print(f"\nConnecting to {MQTT_HOST}:{MQTT_PORT}...")
-    client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-    client.loop_start()
+    client = mqtt_session.get_client()
+    for topic in ACK_TOPICS:
+        mqtt_session.add_handler(topic, on_message)
 
-    # Run for 30 seconds
-    time.sleep(30)
+    run_all_tests(client)
 
-    client.loop_stop()
-    client.disconnect()
+    for topic in ACK_TOPICS:
+        mqtt_session.remove_handler(topic, on_message)
 
     # Print verification instructions
     print("\n" + "="*60)
@@ -202,6 +237,8 @@ def main():
     print("\nExpected Errors:")
     for test in TEST_CASES:
         print(f"  • {test['device_id']}: {test['expected_error']}")
+    if unexpected_acks:
+        print(f"\n❌ Unexpected ACK_OK from: {', '.join(sorted(unexpected_acks))}")
     print("="*60)
 
 if __name__ == "__main__":
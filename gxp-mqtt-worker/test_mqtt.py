@@ -4,16 +4,21 @@ Quick MQTT test script to verify worker is receiving messages.
 Publishes test metadata and chunks to simulate an ESP32 device.
 """
 
-import json
+import logging
+import orjson
 import base64
-import time
 import os
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
-import ssl
+import threading
+import mqtt_session
 
 load_dotenv()
 
+# LOG_LEVEL=DEBUG renders the full JSON of every message this script sends
+# and receives
+log, _log_listener = mqtt_session.setup_logging(__name__)
+
 MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
@@ -25,22 +30,34 @@ TEST_IMAGE = "test_image_001.jpg"
 # Minimal valid JPEG (4 bytes: SOI + EOI)
 JPEG_BYTES = bytes([0xFF, 0xD8, 0xFF, 0xD9])
 
+subscribed = threading.Event()
+ack_event = threading.Event()
+
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        print("✓ Connected to MQTT broker")
+        log.info("✓ Connected to MQTT broker")
+        mqtt_session.remember_tls_session(client)
         # Subscribe to ACK topic to see worker responses
-        client.subscribe(f"ESP32CAM/{TEST_MAC}/ack")
-        print(f"✓ Subscribed to ESP32CAM/{TEST_MAC}/ack")
+        client.subscribe(f"ESP32CAM/{TEST_MAC}/ack", qos=1)
     else:
-        print(f"✗ Connection failed with code {rc}")
+        log.error("✗ Connection failed with code %s", rc)
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    log.info("✓ Subscribed to ESP32CAM/%s/ack", TEST_MAC)
+    subscribed.set()
 
 def on_message(client, userdata, msg):
-    print(f"\n📩 Received on {msg.topic}:")
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
+        if log.isEnabledFor(logging.DEBUG):  # skip the indented render otherwise
+            log.debug("📩 Received on %s:\n%s", msg.topic,
+                      orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
+        else:
+            log.info("📩 Received on %s: %s", msg.topic, msg.payload.decode())
+        if "ACK_OK" in payload:
+            ack_event.set()
     except:
-        print(msg.payload.decode())
+        log.info("📩 Received on %s: %r", msg.topic, msg.payload)
 
 def main():
     print("=" * 60)
@@ -49,9 +66,11 @@ def main():
 
     # Create client
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="test-esp32-sim")
-    client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
+    # Verifying, session-resuming context shared with the other test scripts
+    client.tls_set_context(mqtt_session.TLS_CONTEXT)
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
 
     # Connect
@@ -59,21 +78,28 @@ def main():
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
     client.loop_start()
 
-    time.sleep(2)
+    if not subscribed.wait(timeout=10):
+        client.loop_stop()
+        _log_listener.stop()
+        print("✗ No SUBACK from broker within 10s")
+        return
+
+    # Each publish waits for its PUBACK instead of a fixed delay
 
     # 1. Send status message
-    print(f"\n📤 Publishing status message...")
+    log.info("📤 Publishing status message...")
     status = {
         "device_id": TEST_MAC,
         "status": "Alive",
         "pendingImg": 0
     }
-    client.publish(f"ESP32CAM/{TEST_MAC}/status", json.dumps(status), qos=1)
-    print(json.dumps(status, indent=2))
-    time.sleep(1)
+    info = client.publish(f"ESP32CAM/{TEST_MAC}/status", orjson.dumps(status), qos=1)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(orjson.dumps(status, option=orjson.OPT_INDENT_2).decode())
+    info.wait_for_publish(timeout=5)
 
     # 2. Send metadata
-    print(f"\n📤 Publishing image metadata...")
+    log.info("📤 Publishing image metadata...")
     metadata = {
         "device_id": TEST_MAC,
         "capture_timeStamp": "2025-10-04T18:30:00Z",
@@ -88,9 +114,10 @@ def main():
         "pressure": 1013.25,
         "gas_resistance": 54321.0
     }
-    client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(metadata), qos=1)
-    print(json.dumps(metadata, indent=2))
-    time.sleep(1)
+    info = client.publish(f"ESP32CAM/{TEST_MAC}/data", orjson.dumps(metadata), qos=1)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(orjson.dumps(metadata, option=orjson.OPT_INDENT_2).decode())
+    info.wait_for_publish(timeout=5)
 
     # 3. Send chunks
     for i in range(2):
@@ -105,26 +132,26 @@ def main():
             "payload": chunk_b64
         }
 
-        print(f"\n📤 Publishing chunk {i}...")
-        print(f"   Bytes: {chunk_bytes.hex()}")
-        print(f"   Base64: {chunk_b64}")
+        log.info("📤 Publishing chunk %d... bytes %s, base64 %s", i, chunk_bytes.hex(), chunk_b64)
 
-        client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(chunk), qos=1)
-        time.sleep(0.5)
+        client.publish(f"ESP32CAM/{TEST_MAC}/data", orjson.dumps(chunk), qos=1).wait_for_publish(timeout=5)
 
-    print("\n" + "=" * 60)
-    print("✓ All test messages sent!")
-    print("Waiting for ACK from worker...")
-    print("(Press Ctrl+C to exit)")
-    print("=" * 60)
+    log.info("=" * 60)
+    log.info("✓ All test messages sent!")
+    log.info("Waiting for ACK from worker...")
+    log.info("(Press Ctrl+C to exit)")
+    log.info("=" * 60)
 
     try:
-        while True:
-            time.sleep(1)
+        # Short waits so Ctrl+C is still handled promptly
+        while not ack_event.wait(timeout=1):
+            pass
     except KeyboardInterrupt:
-        print("\n\nShutting down...")
-        client.loop_stop()
-        client.disconnect()
+        pass
+    log.info("Shutting down...")
+    client.loop_stop()
+    client.disconnect()
+    _log_listener.stop()
 
 if __name__ == "__main__":
     main()
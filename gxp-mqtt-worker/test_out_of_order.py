@@ -12,23 +12,36 @@ Expected behavior:
 3. Final image should be identical to in-order delivery
 4. ACK_OK should be sent after all chunks received
 """
-import json
+import asyncio
+import logging
+import orjson
 import base64
-import time
 import os
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
-import ssl
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import hashlib
+import threading
+import mqtt_session
+from supabase_session import get_supabase, get_device_id
 
 load_dotenv()
 
+# The patterns run concurrently, so each logs one line per step;
+# LOG_LEVEL=DEBUG adds the full ACK payloads
+log, _log_listener = mqtt_session.setup_logging(__name__)
+
 MQTT_HOST = os.getenv("MQTT_HOST", "1305ceddedc94b9fa7fba9428fe4624e.s1.eu.hivemq.cloud")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
-TEST_MAC = "OUTOFORDER01"
+# "binary": raw bytes on ESP32CAM/{MAC}/chunk/{chunk_id} (MQTT v5)
+# "json": legacy base64 JSON chunks on ESP32CAM/{MAC}/data
+CHUNK_FORMAT = os.getenv("CHUNK_FORMAT", "binary")
+
+
 TEST_IMAGE = "scrambled.jpg"
 
 # Create a 12-byte JPEG with distinct chunks (4 chunks @ 3 bytes each)
@@ -41,10 +54,74 @@ JPEG_BYTES = bytes([
 ])
 CHUNK_SIZE = 3
 TOTAL_CHUNKS = 4
+# One bit per chunk_id; complete once every bit is set
+COMPLETE_MASK = (1 << TOTAL_CHUNKS) - 1
 
 # Calculate expected hash for verification
 EXPECTED_SHA256 = hashlib.sha256(JPEG_BYTES).hexdigest()
 
+# Every pattern sends the same image, only in a different order; slice it once
+_jpeg_view = memoryview(JPEG_BYTES)
+CHUNKS = [_jpeg_view[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE] for i in range(TOTAL_CHUNKS)]
+CHUNKS_HEX = [chunk.hex() for chunk in CHUNKS]
+if CHUNK_FORMAT == "binary":
+    CHUNK_PROPERTIES = Properties(PacketTypes.PUBLISH)
+    CHUNK_PROPERTIES.UserProperty = [("img", TEST_IMAGE)]
+else:
+    CHUNK_PROPERTIES = None
+
+# Status and metadata differ per device only in device_id, so encode them
+# once with a placeholder and splice each MAC in as bytes
+STATUS_TEMPLATE = orjson.dumps({"device_id": "__DEVICE_ID__", "status": "Alive", "pendingImg": 1})
+METADATA_TEMPLATE = orjson.dumps({
+    "device_id": "__DEVICE_ID__",
+    "capture_timeStamp": "2025-10-04T21:30:00Z",
+    "image_name": TEST_IMAGE,
+    "image_size": len(JPEG_BYTES),
+    "max_chunks_size": CHUNK_SIZE,
+    "total_chunk_count": TOTAL_CHUNKS,
+    "location": "out_of_order_test",
+    "error": 0,
+    "temperature": 23.5,
+    "humidity": 52.0,
+    "pressure": 1012.5,
+    "gas_resistance": 51000.0
+})
+
+def build_messages(device_id, pattern):
+    """Status, metadata, then the chunks in pattern order, as (topic, payload, properties)"""
+    device = device_id.encode()
+    status = STATUS_TEMPLATE.replace(b"__DEVICE_ID__", device)
+    metadata = METADATA_TEMPLATE.replace(b"__DEVICE_ID__", device)
+    messages = [
+        (f"ESP32CAM/{device_id}/status", status, None),
+        (f"ESP32CAM/{device_id}/data", metadata, None),
+    ]
+    for chunk_id in pattern:
+        if CHUNK_FORMAT == "binary":
+            # device_id, image_name and chunk size are already in the metadata
+            # message; the chunk_id rides in the topic and the payload is the bytes
+            messages.append((f"ESP32CAM/{device_id}/chunk/{chunk_id}",
+                             bytes(CHUNKS[chunk_id]), CHUNK_PROPERTIES))
+        else:
+            messages.append((f"ESP32CAM/{device_id}/data", orjson.dumps({
+                "device_id": device_id,
+                "image_name": TEST_IMAGE,
+                "chunk_id": chunk_id,
+                "max_chunk_size": CHUNK_SIZE,
+                "payload": base64.b64encode(CHUNKS[chunk_id]).decode()
+            }), None))
+    return messages
+
+def stored_sha256(device_id):
+    """image_sha256 the worker recorded for this device's capture, or None"""
+    rows = get_supabase().table("captures") \
+        .select("image_sha256") \
+        .eq("device_id", get_device_id(device_id)) \
+        .eq("device_capture_id", TEST_IMAGE) \
+        .execute().data
+    return rows[0]["image_sha256"] if rows else None
+
 # Test different scramble patterns
 SCRAMBLE_PATTERNS = [
     {
@@ -69,144 +146,154 @@ SCRAMBLE_PATTERNS = [
     }
 ]
 
-test_results = []
-ack_received = False
+# Each pattern runs as its own device so all of them can be in flight at
+# once without the worker mixing their assemblies. The whole publish
+# sequence per pattern is built once at import.
+for i, pattern_info in enumerate(SCRAMBLE_PATTERNS, start=1):
+    # A pattern must send every chunk_id exactly once, whatever the order
+    sent_mask = 0
+    for chunk_id in pattern_info["pattern"]:
+        sent_mask |= 1 << chunk_id
+    assert sent_mask == COMPLETE_MASK and len(pattern_info["pattern"]) == TOTAL_CHUNKS, \
+        f"{pattern_info['name']}: {pattern_info['pattern']} does not cover chunks 0-{TOTAL_CHUNKS - 1} once"
+    pattern_info["device_id"] = f"OUTOFORDER{i:02d}"
+    pattern_info["messages"] = build_messages(pattern_info["device_id"], pattern_info["pattern"])
+
+ACK_TIMEOUT_S = 10
+
+subscribed = threading.Event()
+# device_id -> asyncio.Event set when that device's ACK_OK arrives; created
+# inside run_patterns so they belong to its event loop
+ack_events = {}
 
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        print(f"✓ Connected!")
-        client.subscribe(f"ESP32CAM/{TEST_MAC}/ack")
-        print(f"✓ Subscribed to ESP32CAM/{TEST_MAC}/ack")
-        time.sleep(1)
+        log.info("✓ Connected!")
+        mqtt_session.remember_tls_session(client)
+        # One wildcard subscription covers every test device
+        client.subscribe("ESP32CAM/+/ack", qos=1)
     else:
-        print(f"✗ Connection failed: {rc}")
+        log.error("✗ Connection failed: %s", rc)
 
-def on_message(client, userdata, msg):
-    global ack_received
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    log.info("✓ Subscribed to ESP32CAM/+/ack")
+    subscribed.set()
 
-    print(f"\n📩 Received on {msg.topic}:")
+def on_message(client, userdata, msg):
+    device_id = msg.topic.split("/")[1]
     try:
-        payload = json.loads(msg.payload.decode())
-        print(json.dumps(payload, indent=2))
+        payload = orjson.loads(msg.payload)
+        if log.isEnabledFor(logging.DEBUG):  # skip the indented render otherwise
+            log.debug("📩 Received on %s:\n%s", msg.topic,
+                      orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
 
         if "ACK_OK" in payload:
-            ack_received = True
-            print(f"\n✅ ACK_OK received! Image assembly complete.")
+            event = ack_events.get(device_id)
+            if event is not None:
+                # on_message runs on paho's network thread; userdata is the asyncio loop
+                userdata.call_soon_threadsafe(event.set)
+            log.info("✅ [%s] ACK_OK received! Image assembly complete.", device_id)
         elif "missing_chunks" in payload:
-            print(f"\n⚠️  NACK: Missing chunks {payload.get('missing_chunks', [])}")
+            log.warning("⚠️  [%s] NACK: Missing chunks %s", device_id, payload.get("missing_chunks", []))
 
     except Exception as e:
-        print(f"Error: {e}")
-
-def send_scrambled_test(client, pattern_info):
-    global ack_received
-    ack_received = False
+        log.error("Error parsing message on %s: %s", msg.topic, e)
 
+async def send_scrambled_test(client, pattern_info):
+    device_id = pattern_info["device_id"]
     pattern = pattern_info["pattern"]
     name = pattern_info["name"]
     desc = pattern_info["description"]
+    ack_event = ack_events[device_id]
 
-    print(f"\n{'='*70}")
-    print(f"TEST: {name}")
-    print(f"{'='*70}")
-    print(f"Description: {desc}")
-    print(f"Chunk order: {pattern}")
-    print(f"Expected hash: {EXPECTED_SHA256[:16]}...")
-
-    # 1. Status
-    print(f"\n📤 Step 1: Sending status...")
-    status = {"device_id": TEST_MAC, "status": "Alive", "pendingImg": 1}
-    client.publish(f"ESP32CAM/{TEST_MAC}/status", json.dumps(status), qos=1)
-    time.sleep(0.5)
-
-    # 2. Metadata
-    print(f"\n📤 Step 2: Sending metadata ({TOTAL_CHUNKS} chunks)...")
-    metadata = {
-        "device_id": TEST_MAC,
-        "capture_timeStamp": "2025-10-04T21:30:00Z",
-        "image_name": TEST_IMAGE,
-        "image_size": len(JPEG_BYTES),
-        "max_chunks_size": CHUNK_SIZE,
-        "total_chunk_count": TOTAL_CHUNKS,
-        "location": "out_of_order_test",
-        "error": 0,
-        "temperature": 23.5,
-        "humidity": 52.0,
-        "pressure": 1012.5,
-        "gas_resistance": 51000.0
-    }
-    client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(metadata), qos=1)
-    time.sleep(0.5)
+    # One line per test: these run concurrently, so multi-line blocks
+    # would interleave
+    log.info("📤 [%s] %s - %s. Sending status, metadata and %s chunks %s",
+             device_id, name, desc, CHUNK_FORMAT,
+             ", ".join(f"{chunk_id}:{CHUNKS_HEX[chunk_id]}" for chunk_id in pattern))
 
-    # 3. Send chunks in scrambled order
-    print(f"\n📤 Step 3: Sending chunks in scrambled order: {pattern}")
+    # Publish the whole sequence back to back with no I/O in between, then
+    # wait for the PUBACKs once. A single connection keeps publish order,
+    # and the worker copes with a chunk that beats its metadata anyway.
+    infos = [client.publish(topic, payload, qos=1, properties=props)
+             for topic, payload, props in pattern_info["messages"]]
+    await asyncio.to_thread(lambda: [info.wait_for_publish(timeout=5) for info in infos])
 
-    for chunk_id in pattern:
-        start = chunk_id * CHUNK_SIZE
-        end = min(start + CHUNK_SIZE, len(JPEG_BYTES))
-        chunk_bytes = JPEG_BYTES[start:end]
-        chunk_b64 = base64.b64encode(chunk_bytes).decode()
-
-        chunk = {
-            "device_id": TEST_MAC,
-            "image_name": TEST_IMAGE,
-            "chunk_id": chunk_id,
-            "max_chunk_size": CHUNK_SIZE,
-            "payload": chunk_b64
-        }
-
-        print(f"   → Chunk {chunk_id}: {chunk_bytes.hex()}")
-        client.publish(f"ESP32CAM/{TEST_MAC}/data", json.dumps(chunk), qos=1)
-        time.sleep(0.3)
-
-    print(f"\n⏳ Waiting for assembly and ACK...")
-
-    # Wait for ACK
-    timeout = 10
-    elapsed = 0
-    while elapsed < timeout and not ack_received:
-        time.sleep(0.5)
-        elapsed += 0.5
-
-    # Record result
-    result = {
+    log.info("⏳ [%s] Waiting for assembly and ACK...", device_id)
+
+    # Returns as soon as on_message sees ACK_OK
+    try:
+        await asyncio.wait_for(ack_event.wait(), timeout=ACK_TIMEOUT_S)
+        ack_received = True
+    except asyncio.TimeoutError:
+        ack_received = False
+
+    # ACK_OK follows the capture row update, so the hash the worker computed
+    # over its reassembled buffer is in the database by now
+    hash_ok = False
+    if ack_received:
+        sha = await asyncio.to_thread(stored_sha256, device_id)
+        hash_ok = sha == EXPECTED_SHA256
+        if not hash_ok:
+            log.error("✗ [%s] Stored hash %s... does not match expected %s...",
+                      device_id, (sha or "none")[:16], EXPECTED_SHA256[:16])
+
+    passed = ack_received and hash_ok
+    return {
+        "device_id": device_id,
         "pattern_name": name,
         "pattern": pattern,
         "ack_received": ack_received,
-        "status": "✅ PASS" if ack_received else "❌ FAIL"
+        "hash_ok": hash_ok,
+        "passed": passed,
+        "status": "✅ PASS" if passed else "❌ FAIL"
     }
-    test_results.append(result)
 
-    time.sleep(2)  # Gap between tests
+async def run_patterns(client):
+    """Run every scramble pattern concurrently; results come back in pattern order"""
+    client.user_data_set(asyncio.get_running_loop())
+    for pattern_info in SCRAMBLE_PATTERNS:
+        ack_events[pattern_info["device_id"]] = asyncio.Event()
+
+    return await asyncio.gather(*(send_scrambled_test(client, pattern_info)
+                                  for pattern_info in SCRAMBLE_PATTERNS))
 
 def main():
     print("="*70)
     print("Out-of-Order Chunk Delivery Test Suite")
     print("="*70)
-    print(f"\nDevice: {TEST_MAC}")
+    print(f"\nDevices: {', '.join(p['device_id'] for p in SCRAMBLE_PATTERNS)}")
     print(f"Image: {TEST_IMAGE} ({len(JPEG_BYTES)} bytes, {TOTAL_CHUNKS} chunks)")
     print(f"Expected SHA256: {EXPECTED_SHA256}")
     print(f"\nTesting {len(SCRAMBLE_PATTERNS)} different scramble patterns...")
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="out-of-order-test")
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="out-of-order-test",
+                         protocol=mqtt.MQTTv5)  # user properties on binary chunks
+    # Verifying, session-resuming context shared with the other test scripts
+    client.tls_set_context(mqtt_session.TLS_CONTEXT)
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
 
     print(f"\nConnecting to {MQTT_HOST}:{MQTT_PORT}...")
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
     client.loop_start()
 
-    time.sleep(2)
+    if not subscribed.wait(timeout=10):
+        client.loop_stop()
+        _log_listener.stop()
+        print("✗ No SUBACK from broker within 10s")
+        return
 
-    # Run all scramble pattern tests
-    for pattern_info in SCRAMBLE_PATTERNS:
-        send_scrambled_test(client, pattern_info)
+    # Run all scramble patterns at once, one device each, as coroutines on
+    # one thread over the shared client; wall-clock is the slowest pattern
+    # rather than the sum
+    test_results = asyncio.run(run_patterns(client))
 
     client.loop_stop()
     client.disconnect()
+    _log_listener.stop()  # flush queued callback output before the summary
 
     # Print final results
     print("\n" + "="*70)
@@ -214,9 +301,9 @@ def main():
     print("="*70)
 
     for result in test_results:
-        print(f"{result['status']} {result['pattern_name']}: {result['pattern']}")
+        print(f"{result['status']} [{result['device_id']}] {result['pattern_name']}: {result['pattern']}")
 
-    passed = sum(1 for r in test_results if r['ack_received'])
+    passed = sum(1 for r in test_results if r['passed'])
     total = len(test_results)
 
     print(f"\nOverall: {passed}/{total} tests passed")
@@ -224,13 +311,16 @@ def main():
     if passed == total:
         print("\n✅ ALL TESTS PASSED: Worker correctly handles out-of-order chunks!")
         print("\nVerification Steps:")
-        print("1. Check Supabase Storage for image:")
-        print(f"   Path: captures/{TEST_MAC}/2025/10/04/{TEST_IMAGE}")
-        print(f"2. Verify image SHA256 hash: {EXPECTED_SHA256}")
-        print("3. Download and check JPEG is valid (opens correctly)")
+        print("1. Check Supabase Storage for images:")
+        for result in test_results:
+            print(f"   Path: captures/{result['device_id']}/2025/10/04/{TEST_IMAGE}")
+        print(f"   (stored image_sha256 already matched {EXPECTED_SHA256[:16]}... for each)")
+        print("2. Download and check JPEG is valid (opens correctly)")
         print("\nSQL Verification:")
-        print(f"SELECT image_sha256, image_bytes, ingest_status FROM captures")
-        print(f"WHERE device_hw_id='{TEST_MAC}' ORDER BY created_at DESC LIMIT 1;")
+        device_list = ", ".join(f"'{r['device_id']}'" for r in test_results)
+        print(f"SELECT DISTINCT ON (device_hw_id) device_hw_id, image_sha256, image_bytes, ingest_status")
+        print(f"FROM captures WHERE device_hw_id IN ({device_list})")
+        print(f"ORDER BY device_hw_id, created_at DESC;")
     else:
         print(f"\n❌ {total - passed} TEST(S) FAILED")
         print("Worker may not be correctly handling out-of-order chunk delivery.")
@@ -0,0 +1,23 @@
+"""
+TLS session resumption for MQTT clients.
+
+Used by the worker (app.make_tls_context) and by the test scripts
+(mqtt_session.TLS_CONTEXT), so both resume sessions the same way.
+"""
+import ssl
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    SSLContext that offers the last broker TLS session on every new socket,
+    so a reconnect resumes the session instead of a full handshake.
+    paho calls wrap_socket() on the context it is given; store the session
+    in tls_session from on_connect (TLS 1.3 tickets arrive after the
+    handshake).
+    """
+    tls_session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.tls_session is not None and kwargs.get("session") is None:
+            kwargs["session"] = self.tls_session
+        return super().wrap_socket(sock, *args, **kwargs)